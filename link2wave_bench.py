@@ -0,0 +1,359 @@
+"""Throughput benchmarks for Link2Wave's audio paths (CPU, synthetic input)"""
+import argparse, json, os, platform, resource, shutil, statistics, subprocess, sys, tempfile, time, uuid
+import numpy as np
+import soundfile as sf
+
+import link2wave_web
+from link2wave_web import LivePitch, SeparationService, _segment_worker, autotune, process_pitch, split
+
+SR = 44100
+
+def sine_sweep(seconds, sr=SR, seed=0):
+    """Deterministic vocal-ish test signal: a slow glide with vibrato and a little noise"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sr)) / sr
+    f = 220 * 2 ** (np.sin(2 * np.pi * t / 8) / 2) * (1 + 0.01 * np.sin(2 * np.pi * 5 * t))
+    y = 0.4 * np.sin(2 * np.pi * np.cumsum(f) / sr) + 0.01 * rng.standard_normal(len(t))
+    return y.astype(np.float32)
+
+def bench_autotune(seconds, strength=1.0):
+    """Realtime factor (audio seconds per wall second) of the autotune engine"""
+    y = sine_sweep(seconds)
+    start = time.perf_counter()
+    autotune(y, SR, strength)
+    return seconds / (time.perf_counter() - start)
+
+def bench_live(seconds, block, mode):
+    """(per-block ms percentiles p50/p99/max, realtime factor) for the /live DSP fed block by block"""
+    y = sine_sweep(seconds)
+    dsp = LivePitch(SR, mode, 10 if mode == "autotune" else 3)
+    times = []
+    for start in range(0, len(y), block):
+        t = time.perf_counter()
+        dsp.process(y[start:start + block])
+        times.append(time.perf_counter() - t)
+    return np.percentile(times, [50, 99, 100]) * 1000, seconds / sum(times)
+
+HEAVY_MODULES = ("torch", "demucs", "librosa", "yt_dlp", "sounddevice", "simpleaudio")
+
+def import_cost():
+    """(seconds, heavy modules loaded) for importing the server in a fresh interpreter"""
+    code = ("import sys, time; t = time.perf_counter(); import link2wave_web; "
+            "print(time.perf_counter() - t); print(' '.join(m for m in %r if m in sys.modules))" % (HEAVY_MODULES,))
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__))).stdout.splitlines()
+    return float(out[0]), out[1].split() if len(out) > 1 else []
+
+def bench_separation(seconds, procs, model="htdemucs"):
+    """Wall seconds for one separation; procs=0 is the single-process path"""
+    svc = SeparationService(batch=1, wait=0, procs=procs)
+    with tempfile.TemporaryDirectory() as tmp:
+        warm, src = os.path.join(tmp, "warm.wav"), os.path.join(tmp, "src.wav")
+        sf.write(warm, sine_sweep(5), SR)
+        sf.write(src, sine_sweep(seconds), SR)
+        # Load the model (and spawn the workers) before timing anything
+        svc.separate(warm, os.path.join(tmp, "warm"), model)
+        if svc.pool:
+            tiny = np.zeros((2, SR), dtype=np.float32)
+            list(svc.pool.map(_segment_worker, [model] * procs, [tiny] * procs, [{}] * procs))
+        start = time.perf_counter()
+        svc.separate(src, os.path.join(tmp, "out"), model)
+        elapsed = time.perf_counter() - start
+    if svc.pool:
+        svc.pool.shutdown()
+    return elapsed
+
+def write_long_fixture(path, seconds, sr=SR, block=60):
+    """Write a long synthetic file a block at a time, so the fixture itself never sits in RAM"""
+    with sf.SoundFile(path, "w", sr, 1) as f:
+        for start in range(0, int(seconds), block):
+            f.write(sine_sweep(min(block, seconds - start), sr, seed=start))
+
+def write_fixtures(folder, seconds, sr=SR):
+    """Deterministic stereo fixtures of one length: fixture.wav, plus Opus copies standing in
+    for a YouTube download (source.webm) and a browser take (take.webm)"""
+    wav = os.path.join(folder, "fixture.wav")
+    with sf.SoundFile(wav, "w", sr, 2) as f:
+        for start in range(0, int(seconds), 60):
+            n = min(60, seconds - start)
+            f.write(np.stack([sine_sweep(n, sr, seed=start), sine_sweep(n, sr, seed=start + 1)], axis=1))
+    for name in ("source.webm", "take.webm"):
+        link2wave_web.run(f'ffmpeg {link2wave_web.FFMPEG_OPTS} -y -i "{wav}" -c:a libopus -b:a 128k "{os.path.join(folder, name)}"')
+    return wav
+
+def _checked(result):
+    path, err = result
+    if err:
+        raise RuntimeError(err)
+    return path
+
+def _rip(wav):
+    # yank and the metadata probe are stubbed: the "download" is a copy of the local Opus fixture,
+    # under a fresh video id so the rip library never short-circuits the timed work
+    source = os.path.join(os.path.dirname(wav), "source.webm")
+    link2wave_web.video_info = lambda url, work: {"id": uuid.uuid4().hex, "extractor_key": "Benchmark", "title": "source"}
+    link2wave_web.yank = lambda url, tmp, on_progress=None: link2wave_web.pathlib.Path(shutil.copy(source, tmp))
+    return link2wave_web.rip_audio("https://www.youtube.com/watch?v=benchmark", "mp3", stream=False)
+
+# Stand-in yt-dlp for stream rips: -J prints metadata under a fresh id, -o - writes the Opus
+# fixture to stdout (only half of it, then fails, when L2W_BENCH_FAIL_DOWNLOAD is set)
+FAKE_YTDLP = """#!{python}
+import json, os, sys, uuid
+if "-J" in sys.argv:
+    sys.exit(print(json.dumps({{"id": uuid.uuid4().hex, "extractor_key": "Benchmark", "title": "source"}})))
+with open({source!r}, "rb") as f:
+    data = f.read()
+if os.environ.get("L2W_BENCH_FAIL_DOWNLOAD"):
+    sys.stdout.buffer.write(data[:len(data) // 2])
+    sys.exit("ERROR: download interrupted")
+sys.stdout.buffer.write(data)
+"""
+
+def _stream_rip(wav):
+    # The real yt-dlp -> ffmpeg pipe, fed by the stand-in above placed first on PATH
+    bin_dir = tempfile.mkdtemp()
+    fake = os.path.join(bin_dir, "yt-dlp")
+    with open(fake, "w") as f:
+        f.write(FAKE_YTDLP.format(python=sys.executable, source=os.path.join(os.path.dirname(wav), "source.webm")))
+    os.chmod(fake, 0o755)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+    link2wave_web.yt_dlp_cmd = lambda: "yt-dlp"  # not a project .venv's copy
+    out = link2wave_web.rip_audio("https://www.youtube.com/watch?v=benchmark", "mp3", stream=True)
+    if not os.path.getsize(out):
+        raise RuntimeError(f"stream rip wrote an empty file: {out}")
+    return out
+
+# Suite operations: (capability imported or executable checked before timing, fn on fixture.wav),
+# each run in a fresh child process. The rips stand in for yt-dlp, so they only need ffmpeg.
+OPS = {
+    "rip": ("ffmpeg", _rip),
+    "rip-stream": ("ffmpeg", _stream_rip),
+    "trans": ("ffmpeg", lambda wav: link2wave_web.trans(link2wave_web.pathlib.Path(wav), "mp3")),
+    "split": ("separation", lambda wav: split(wav)),
+    "pitch-shift": ("pitch", lambda wav: _checked(process_pitch(wav, 2, correction=False))),
+    "autotune": ("pitch", lambda wav: _checked(process_pitch(wav, 10, correction=True))),
+    "convert": ("ffmpeg", lambda wav: _checked(link2wave_web.convert_audio(os.path.join(os.path.dirname(wav), "take.webm"), "wav"))),
+}
+MEMORY_OPS = {"pitch": "pitch-shift", "autotune": "autotune", "separate": "split"}
+
+def child_peak_rss():
+    """This process's peak RSS in bytes. VmHWM starts at exec, unlike ru_maxrss, which keeps the parent's"""
+    try:
+        with open("/proc/self/status") as f:
+            return next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmHWM:"))
+    except (OSError, StopIteration):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+
+def run_op(op, path, workdir, **env):
+    """{wall_seconds, peak_rss_mb} or {error} for op in a fresh interpreter whose home and temp
+    directories are workdir, so caches start cold and nothing lands in the real library"""
+    env = dict(os.environ, HOME=workdir, TMPDIR=workdir, USERPROFILE=workdir, **env)
+    p = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", op, path],
+                       capture_output=True, text=True, env=env)
+    lines = p.stdout.strip().splitlines()
+    if p.returncode or not lines:
+        return {"error": (p.stderr.strip().splitlines() or ["failed"])[-1]}
+    return json.loads(lines[-1])
+
+def peak_rss_mb(what, path, chunk_seconds):
+    """Peak RSS of a fresh child process running one pipeline stage on path, windowed past chunk_seconds"""
+    with tempfile.TemporaryDirectory() as work:
+        result = run_op(MEMORY_OPS[what], path, work, L2W_CHUNK_SECONDS=str(chunk_seconds))
+    if "error" in result:
+        sys.exit(result["error"])
+    return result["peak_rss_mb"]
+
+def run_child(op, path):
+    need, fn = OPS[op]
+    if need in link2wave_web.CAPABILITIES:
+        link2wave_web.require(need)
+    elif not shutil.which(need):
+        raise RuntimeError(f"{op} is not available (missing: {need})")
+    start = time.perf_counter()
+    fn(path)
+    print(json.dumps({"wall_seconds": time.perf_counter() - start, "peak_rss_mb": child_peak_rss() / 2**20}))
+
+def check_stream_rip(seconds=10):
+    """Problems stream-ripping the Opus fixture through the stand-in yt-dlp: the rip must land in
+    the library, and an interrupted download must fail without leaving a partial file behind"""
+    problems = []
+    with tempfile.TemporaryDirectory() as tmp:
+        wav = write_fixtures(tmp, seconds)
+        good, bad = os.path.join(tmp, "good"), os.path.join(tmp, "bad")
+        os.mkdir(good); os.mkdir(bad)
+        result = run_op("rip-stream", wav, good)
+        library = lambda work: os.listdir(os.path.join(work, "Music", "YT-Rips"))
+        if "error" in result:
+            problems.append(result["error"])
+        elif not any(n.endswith(".mp3") for n in library(good)):
+            problems.append("no mp3 in the library")
+        if "error" not in run_op("rip-stream", wav, bad, L2W_BENCH_FAIL_DOWNLOAD="1"):
+            problems.append("an interrupted download did not fail")
+        problems += [f"left behind {n}" for n in library(bad) if ".part" in n or n.endswith(".mp3")]
+    return problems
+
+def environment():
+    """What a result depends on: commit, interpreter, machine and library versions"""
+    from importlib.metadata import PackageNotFoundError, version
+    def pkg(name):
+        try:
+            return version(name)
+        except PackageNotFoundError:
+            return None
+    here = os.path.dirname(os.path.abspath(__file__))
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=here, capture_output=True, text=True).stdout.strip()
+    ffmpeg = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout.split("\n")[0]
+    return {"commit": commit or None, "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "platform": platform.platform(), "cpus": os.cpu_count(), "ffmpeg": ffmpeg,
+            "packages": {name: pkg(name) for name in ("numpy", "librosa", "soundfile", "torch", "demucs", "yt-dlp")}}
+
+def run_suite(lengths, ops, repeat=1):
+    """Every op on every fixture length; wall time is the median of repeat cold runs"""
+    results = []
+    for seconds in lengths:
+        with tempfile.TemporaryDirectory() as tmp:
+            wav = write_fixtures(tmp, seconds)
+            for op in ops:
+                runs = []
+                for i in range(repeat):
+                    work = os.path.join(tmp, f"{op}-{i}")
+                    os.mkdir(work)
+                    runs.append(run_op(op, wav, work))
+                    shutil.rmtree(work)
+                    if "error" in runs[-1]:
+                        break
+                row = {"op": op, "audio_seconds": seconds}
+                if "error" in runs[-1]:
+                    row["error"] = runs[-1]["error"]
+                else:
+                    wall = statistics.median(r["wall_seconds"] for r in runs)
+                    row.update(wall_seconds=round(wall, 3), realtime_factor=round(seconds / wall, 2),
+                               peak_rss_mb=round(max(r["peak_rss_mb"] for r in runs), 1), runs=len(runs))
+                print(f"suite {op:<12} {seconds:>6.0f}s  " + (f"FAILED: {row['error']}" if "error" in row else
+                      f"{row['wall_seconds']:8.2f}s  {row['realtime_factor']:7.2f}x realtime  "
+                      f"peak RSS {row['peak_rss_mb']:7.0f} MB"))
+                results.append(row)
+    return results
+
+def compare(results, baseline_path):
+    """Print realtime-factor and RSS changes against a saved run"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    before = {(r["op"], r["audio_seconds"]): r for r in baseline["results"] if "error" not in r}
+    print(f"vs {baseline_path} (commit {baseline['environment'].get('commit')})")
+    for row in results:
+        old = before.get((row["op"], row["audio_seconds"]))
+        if old and "error" not in row:
+            print(f"  {row['op']:<12} {row['audio_seconds']:>6.0f}s  speed {row['realtime_factor'] / old['realtime_factor']:5.2f}x  "
+                  f"RSS {row['peak_rss_mb'] - old['peak_rss_mb']:+7.0f} MB")
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--lengths", type=float, nargs="*", default=[10, 60, 180],
+                    help="autotune clip lengths in seconds (none skips)")
+    ap.add_argument("--import-budget-ms", type=float, default=1000,
+                    help="fail if importing the server takes longer than this")
+    ap.add_argument("--separate-seconds", type=float, default=0,
+                    help="also time Demucs on a clip this long (0 skips)")
+    ap.add_argument("--separate-workers", type=int, nargs="+", default=[1, 4, 16])
+    ap.add_argument("--live-seconds", type=float, default=30,
+                    help="stream this much audio through the live pitch DSP (0 skips)")
+    ap.add_argument("--live-block", type=int, default=1024, help="live block size in samples")
+    ap.add_argument("--live-budget-ms", type=float, default=50,
+                    help="fail if a live block's p99 processing time exceeds this")
+    ap.add_argument("--memory-minutes", type=float, nargs="*", default=[3, 30],
+                    help="check peak RSS on synthetic files of these lengths (none skips)")
+    ap.add_argument("--memory-chunk-seconds", type=float, default=60,
+                    help="L2W_CHUNK_SECONDS for the memory check, so a short file takes the long-file path")
+    ap.add_argument("--memory-stage", choices=["pitch", "autotune", "separate"], default="pitch")
+    ap.add_argument("--rss-ceiling-mb", type=float, default=2048)
+    ap.add_argument("--rss-growth-mb", type=float, default=150,
+                    help="fail if peak RSS on the longest file exceeds the shortest by more than this")
+    ap.add_argument("--memory-only", action="store_true", help="run only the memory check")
+    ap.add_argument("--suite", action="store_true",
+                    help="also run the pipeline suite (rip, trans, split, pitch, convert) in cold child processes")
+    ap.add_argument("--suite-lengths", type=float, nargs="+", default=[10, 60, 180])
+    ap.add_argument("--ops", nargs="+", choices=list(OPS), default=list(OPS))
+    ap.add_argument("--repeat", type=int, default=1, help="cold runs per suite op (median wall time is kept)")
+    ap.add_argument("--json", metavar="PATH", help="save the suite's results and environment as JSON")
+    ap.add_argument("--compare", metavar="PATH", help="compare the suite against a saved --json run")
+    ap.add_argument("--child", nargs=2, metavar=("STAGE", "PATH"), help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    if args.child:
+        return run_child(*args.child)
+
+    if args.memory_only:
+        args.lengths, args.live_seconds, args.separate_seconds, args.suite = [], 0, 0, False
+    import_ok = True
+    if not args.memory_only:
+        seconds, heavy = import_cost()
+        import_ok = seconds * 1000 <= args.import_budget_ms and not heavy
+        print(f"import link2wave_web  {seconds * 1000:6.0f} ms  {'OK' if import_ok else 'OVER'} "
+              f"(budget {args.import_budget_ms:.0f} ms, heavy modules loaded: {', '.join(heavy) or 'none'})")
+
+    stream_ok = True
+    if not args.memory_only:
+        if shutil.which("ffmpeg"):
+            problems = check_stream_rip()
+            stream_ok = not problems
+            print(f"stream rip  {'OK' if stream_ok else 'FAILED: ' + '; '.join(problems)}")
+        else:
+            print("stream rip  skipped (ffmpeg not found)")
+
+    if args.lengths:
+        bench_autotune(1)  # warm up librosa's lazy imports and FFT plans
+    for seconds in args.lengths:
+        rtf = bench_autotune(seconds)
+        print(f"autotune {seconds:>6.0f}s  {rtf:6.1f}x realtime  {'OK' if rtf > 1 else 'SLOWER THAN REALTIME'}")
+
+    live_ok = True
+    for mode in ("shift", "autotune") if args.live_seconds else ():
+        (p50, p99, worst), rtf = bench_live(args.live_seconds, args.live_block, mode)
+        ok = p99 <= args.live_budget_ms
+        live_ok &= ok
+        print(f"live {mode:<8} {args.live_block} samples  p50 {p50:5.2f} ms  p99 {p99:5.2f} ms  max {worst:5.2f} ms  "
+              f"{rtf:6.1f}x realtime  {'OK' if ok else 'OVER'} (budget {args.live_budget_ms:.0f} ms)")
+
+    if args.separate_seconds:
+        base = bench_separation(args.separate_seconds, 0)
+        print(f"separate {args.separate_seconds:>5.0f}s  single process  {base:7.1f}s  "
+              f"{args.separate_seconds / base:5.2f}x realtime")
+        for procs in args.separate_workers:
+            wall = bench_separation(args.separate_seconds, procs)
+            print(f"separate {args.separate_seconds:>5.0f}s  {procs:>2} workers      {wall:7.1f}s  "
+                  f"{args.separate_seconds / wall:5.2f}x realtime  {base / wall:4.1f}x vs single")
+
+    memory_ok = True
+    peaks = []
+    for minutes in sorted(m for m in args.memory_minutes if m):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "long.wav")
+            write_long_fixture(path, minutes * 60)
+            rss = peak_rss_mb(args.memory_stage, path, args.memory_chunk_seconds)
+        peaks.append(rss)
+        ok = rss <= args.rss_ceiling_mb
+        memory_ok &= ok
+        print(f"{args.memory_stage} {minutes:>4.0f} min  peak RSS {rss:7.0f} MB  "
+              f"{'OK' if ok else 'OVER'} (ceiling {args.rss_ceiling_mb:.0f} MB)")
+    if len(peaks) > 1:
+        # Windowed processing keeps peak RSS flat, so a longer file must not cost much more
+        ok = peaks[-1] - peaks[0] <= args.rss_growth_mb
+        memory_ok &= ok
+        print(f"{args.memory_stage} growth  peak RSS {peaks[-1] - peaks[0]:+7.0f} MB  "
+              f"{'OK' if ok else 'OVER'} (budget {args.rss_growth_mb:.0f} MB)")
+    suite_ok = True
+    if args.suite:
+        results = run_suite(args.suite_lengths, args.ops, args.repeat)
+        suite_ok = not any("error" in row for row in results)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"environment": environment(), "results": results}, f, indent=2)
+        if args.compare:
+            compare(results, args.compare)
+
+    if not (import_ok and stream_ok and live_ok and memory_ok and suite_ok):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,206 +1,2228 @@
-import subprocess, threading, tempfile, json, sys, shlex, hashlib, shutil, pathlib, os
+import subprocess, threading, tempfile, json, sys, shlex, hashlib, shutil, pathlib, os, time, queue, sqlite3, uuid, io, zipfile
+import importlib, importlib.util, functools, logging, traceback
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+import multiprocessing
 from flask import Flask, render_template_string, request, redirect, url_for, flash, Response, jsonify, send_file, render_template
+import numpy as np
 # === Runtime deps ===
-try:
-    import torch, simpleaudio as sa, yt_dlp, demucs.separate   # noqa
-    import numpy as np
-    # Add sounddevice for pitch processing
-    try:
-        import sounddevice as sd
-        import soundfile as sf
-        import librosa
-    except ImportError:
-        print("Warning: sounddevice, soundfile, or librosa not installed. Pitch processing will not be available.")
-except ImportError as boom:
-    sys.exit(f"Missing lib: {boom}. Activate venv & pip install deps first.")
+# Heavy backends are imported on first use, so startup stays fast and a worker
+# that only serves downloads never pays for torch/librosa. What each feature
+# needs is listed in CAPABILITIES and reported by /capabilities.
+class LazyModule:
+    """Stands in for a module and imports it (plus any submodules) on first attribute access"""
+    def __init__(self, name, *submodules):
+        self._name, self._submodules = name, submodules
+        self._mod, self._lock = None, threading.Lock()
+
+    def __getattr__(self, attr):
+        if self._mod is None:
+            with self._lock:
+                if self._mod is None:
+                    mod = importlib.import_module(self._name)
+                    for sub in self._submodules:
+                        importlib.import_module(f"{self._name}.{sub}")
+                    self._mod = mod
+        return getattr(self._mod, attr)
+
+torch = LazyModule("torch")
+demucs = LazyModule("demucs", "apply", "audio", "pretrained")
+yt_dlp = LazyModule("yt_dlp")
+sa = LazyModule("simpleaudio")
+sd = LazyModule("sounddevice")
+sf = LazyModule("soundfile")
+librosa = LazyModule("librosa")
+
+CAPABILITIES = {
+    # Rips run the yt-dlp executable (piped into ffmpeg); the module only names files
+    'rip': {'modules': ['yt_dlp'], 'binaries': ['yt-dlp', 'ffmpeg']},
+    'separation': {'modules': ['torch', 'demucs', 'soundfile'], 'binaries': ['ffmpeg']},
+    'pitch': {'modules': ['soundfile', 'librosa'], 'binaries': []},
+    'preview': {'modules': ['soundfile'], 'binaries': ['ffmpeg']},
+    'wav-preview': {'modules': ['soundfile'], 'binaries': []},
+    'local-preview': {'modules': ['sounddevice', 'soundfile'], 'binaries': []},
+    'live': {'modules': ['flask_sock'], 'binaries': []},
+}
+_import_errors = {}
+
+def capability(name):
+    """Whether a feature can run here, judged without importing anything heavy"""
+    need = CAPABILITIES[name]
+    missing = [m for m in need['modules'] if m in _import_errors or importlib.util.find_spec(m) is None]
+    missing += [b for b in need['binaries'] if not shutil.which(yt_dlp_cmd() if b == 'yt-dlp' else b)]
+    return {'available': not missing, 'missing': missing,
+            'loaded': all(m in sys.modules for m in need['modules'])}
+
+def require(name):
+    """Import a feature's backends now; a RuntimeError explains what is missing"""
+    cap = capability(name)
+    if not cap['available']:
+        raise RuntimeError(f"{name} is not available (missing: {', '.join(cap['missing'])})")
+    for m in CAPABILITIES[name]['modules']:
+        try:
+            importlib.import_module(m)
+        except Exception as e:  # sounddevice raises OSError without PortAudio
+            _import_errors[m] = str(e)
+            raise RuntimeError(f"{name} is not available ({m}: {e})")
 
 DEST_DIR = pathlib.Path.home() / "Music" / "YT-Rips"; DEST_DIR.mkdir(parents=True, exist_ok=True)
 LAST_RIP = None; FFMPEG_OPTS = "-hide_banner -loglevel error"
-PROCESSING = False
+STREAM_RIPS = os.environ.get('L2W_STREAM_RIPS', '1') != '0'
 CURRENT_STEMS = {}
 
 app = Flask(__name__)
+log = logging.getLogger("link2wave")
+
+def expire_files(root, pattern, ttl, budget, keep=None):
+    """Delete files in root older than ttl, then least-recently-used ones until they fit budget bytes"""
+    now, files = time.time(), []
+    for f in pathlib.Path(root).glob(pattern):
+        if f.name.startswith("."):
+            continue  # still being written
+        try:
+            st = f.stat()
+        except FileNotFoundError:
+            continue
+        if now - st.st_mtime > ttl and f != keep:
+            f.unlink(missing_ok=True)
+        else:
+            files.append((st.st_mtime, st.st_size, f))
+    total = sum(size for _, size, _ in files)
+    for _, size, f in sorted(files, key=lambda t: t[0]):
+        if total <= budget:
+            break
+        if f != keep:
+            f.unlink(missing_ok=True)
+            total -= size
+
+def every(seconds, fn, name):
+    """Call fn every so many seconds on a daemon thread, logging (not raising) its errors"""
+    def loop():
+        while True:
+            time.sleep(seconds)
+            try:
+                fn()
+            except Exception:
+                log.exception("%s failed", name)
+    thread = threading.Thread(target=loop, name=name, daemon=True)
+    thread.start()
+    return thread
 app.secret_key = "link2wave_secret_key"
+# WebSocket routes need flask-sock; without it /live is simply not registered
+sock = importlib.import_module('flask_sock').Sock(app) if importlib.util.find_spec('flask_sock') else None
+
+# === Metrics ===
+# Counters, gauges and histograms kept in process and exposed in Prometheus'
+# text format on /metrics. Pipeline steps run inside span()s; while a job
+# stage is running, every span (and every external command) is also appended
+# to that job's trace, fetched later from /jobs/<id>/trace.
+TRACE_JOBS = os.environ.get('L2W_TRACE', '1') != '0'
+
+class Metrics:
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.meta = {}  # name -> (type, help), in exposition order
+        self.samples = {}  # name -> {labels: value} for counters and gauges
+        self.hists = {}  # name -> {labels: [bucket counts..., sum, count]}
+        self.collectors = []  # fn() -> [(name, labels, value)], read at scrape time
+
+    def describe(self, name, kind, text):
+        self.meta[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.samples.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set_max(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.samples.setdefault(name, {})
+            series[key] = max(series.get(key, 0), value)
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            h = self.hists.setdefault(name, {}).setdefault(key, [0] * (len(self.BUCKETS) + 2))
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def render(self):
+        def fmt(name, labels, value):
+            inner = ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for k, v in labels)
+            return f"{name}{{{inner}}} {value:.17g}" if inner else f"{name} {value:.17g}"
+        collected = {}
+        for collect in self.collectors:
+            for name, labels, value in collect():
+                collected.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+        lines = []
+        with self.lock:
+            for name, (kind, text) in self.meta.items():
+                lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+                for labels, value in {**self.samples.get(name, {}), **collected.get(name, {})}.items():
+                    lines.append(fmt(name, labels, value))
+                for labels, h in self.hists.get(name, {}).items():
+                    for bound, n in zip((*self.BUCKETS, '+Inf'), (*h[:len(self.BUCKETS)], h[-1])):
+                        lines.append(fmt(f"{name}_bucket", (*labels, ('le', bound)), n))
+                    lines += [fmt(f"{name}_sum", labels, h[-2]), fmt(f"{name}_count", labels, h[-1])]
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+for _name, _kind, _help in [
+    ('l2w_stage_seconds', 'histogram', 'Wall time of pipeline steps (download, transcode, separate, pitch, ...)'),
+    ('l2w_stage_errors_total', 'counter', 'Pipeline steps that raised'),
+    ('l2w_bytes_total', 'counter', 'Bytes read (in) and written (out) by pipeline steps'),
+    ('l2w_cache_requests_total', 'counter', 'Cache lookups by cache and result (hit or miss)'),
+    ('l2w_command_seconds', 'histogram', 'Wall time of external commands (ffmpeg, yt-dlp, ...)'),
+    ('l2w_command_cpu_seconds_total', 'counter', 'CPU time used by external commands'),
+    ('l2w_command_max_rss_bytes', 'gauge', 'Largest peak RSS seen for each external command'),
+    ('l2w_job_stage_seconds', 'histogram', 'Wall time of job stages by job kind and stage'),
+    ('l2w_queue_wait_seconds', 'histogram', 'Time job stages spent queued before a worker took them'),
+    ('l2w_queue_depth', 'gauge', 'Job stages waiting in each worker pool'),
+    ('l2w_jobs', 'gauge', 'Jobs in the job store by status'),
+    ('l2w_process_max_rss_bytes', 'gauge', 'Peak RSS of this server process'),
+]:
+    METRICS.describe(_name, _kind, _help)
+
+_trace = threading.local()
+
+def current_trace():
+    """The event list of the job stage running on this thread, or None"""
+    return getattr(_trace, 'events', None)
 
-def run(cmd, quiet=False):
-    p = subprocess.run(shlex.split(cmd), capture_output=True, text=True)
-    if p.returncode: raise RuntimeError(p.stderr or cmd)
-    return p.stdout.strip()
+def trace_event(**event):
+    events = current_trace()
+    if events is not None:
+        events.append(event)
 
-def yank(url, tmp):
-    out = pathlib.Path(tmp) / "%(title)s.%(ext)s"
-    yt_dlp_cmd = "yt-dlp"
+def process_peak_rss():
+    """Peak RSS of this process in bytes (0 where the platform can't tell)"""
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class span:
+    """Time a pipeline step: histogram, error count, byte counters and a trace event"""
+    def __init__(self, stage):
+        self.stage = stage
+        self.fields = {}
+
+    def __enter__(self):
+        spans = _trace.__dict__.setdefault('spans', [])
+        spans.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _trace.spans.pop()
+        seconds = time.time() - self.start
+        METRICS.observe('l2w_stage_seconds', seconds, stage=self.stage)
+        if exc_type:
+            METRICS.inc('l2w_stage_errors_total', stage=self.stage)
+        trace_event(type='span', name=self.stage, start=self.start, seconds=round(seconds, 4), ok=exc_type is None,
+                    process_peak_rss_mb=round(process_peak_rss() / 2**20, 1), **self.fields)
+
+def timed(stage):
+    """Decorator: run every call inside span(stage)"""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return inner
+    return wrap
+
+def count_bytes(direction, *paths):
+    """Credit the size of paths (files or directories) to the innermost span as bytes in or out"""
+    spans = getattr(_trace, 'spans', None)
+    if not spans:
+        return
+    n = sum(dir_size(p) if os.path.isdir(p) else os.path.getsize(p) for p in paths if os.path.exists(p))
+    METRICS.inc('l2w_bytes_total', n, stage=spans[-1].stage, direction=direction)
+    key = f"bytes_{direction}"
+    spans[-1].fields[key] = spans[-1].fields.get(key, 0) + n
+
+def cache_result(cache, hit):
+    METRICS.inc('l2w_cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+def watch_rss(pid, every=0.1):
+    """Follow a child's peak RSS (VmHWM) in /proc until it exits; returns the dict being filled"""
+    peak = {'bytes': 0}
+    def sample():
+        # ru_maxrss from wait4 would include our own RSS, carried over the fork
+        while True:
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    hwm = next((int(line.split()[1]) * 1024 for line in f if line.startswith("VmHWM:")), None)
+            except OSError:
+                return
+            if hwm is None:  # exited, not yet reaped
+                return
+            peak['bytes'] = max(peak['bytes'], hwm)
+            time.sleep(every)
+    if os.path.isdir("/proc"):
+        threading.Thread(target=sample, daemon=True).start()
+    return peak
+
+def reap(p, name, start, peak=None):
+    """p.wait(), also recording the command's wall time, CPU time and (given watch_rss) peak RSS"""
+    usage = None
+    if hasattr(os, 'wait4'):
+        try:
+            _, status, usage = os.wait4(p.pid, 0)
+            p.returncode = os.waitstatus_to_exitcode(status)
+        except ChildProcessError:  # already reaped
+            pass
+    p.wait()
+    seconds = time.time() - start
+    name = os.path.basename(name)
+    METRICS.observe('l2w_command_seconds', seconds, command=name)
+    event = {'type': 'command', 'name': name, 'start': start, 'seconds': round(seconds, 4), 'ok': p.returncode == 0}
+    if usage is not None:
+        METRICS.inc('l2w_command_cpu_seconds_total', usage.ru_utime + usage.ru_stime, command=name)
+        event['cpu_seconds'] = round(usage.ru_utime + usage.ru_stime, 3)
+    if peak and peak['bytes']:
+        METRICS.set_max('l2w_command_max_rss_bytes', peak['bytes'], command=name)
+        event['peak_rss_mb'] = round(peak['bytes'] / 2**20, 1)
+    trace_event(**event)
+    return p.returncode
+
+def run(cmd, quiet=False, on_line=None):
+    args, start = shlex.split(cmd), time.time()
+    if not on_line:
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        peak, err = watch_rss(p.pid), []
+        reader = threading.Thread(target=lambda: err.append(p.stderr.read()), daemon=True); reader.start()
+        out = p.stdout.read(); reader.join()
+        if reap(p, args[0], start, peak): raise RuntimeError(err[0] or cmd)
+        return out.strip()
+    # Hand each output line to on_line as it arrives (progress parsing)
+    p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors="replace")
+    peak, lines = watch_rss(p.pid), []
+    for line in p.stdout:
+        lines.append(line)
+        on_line(line.strip())
+    if reap(p, args[0], start, peak): raise RuntimeError("".join(lines[-20:]) or cmd)
+    return "".join(lines).strip()
+
+# Progress callbacks are report(stage, fraction); these adapt tool output to them
+YTDLP_PROGRESS = ["--newline", "--progress-template",
+                  "download:L2W %(progress.downloaded_bytes)s %(progress.total_bytes)s %(progress.total_bytes_estimate)s"]
+no_progress = lambda stage, frac: None
+
+def ytdlp_progress(report):
+    def on_line(line):
+        if line.startswith("L2W "):
+            done, total, estimate = (line.split() + ["NA"] * 3)[1:4]
+            try: report("download", float(done) / float(total if total != "NA" else estimate))
+            except (ValueError, ZeroDivisionError): pass
+    return on_line
+
+def ffmpeg_progress(report, duration, stage="transcode"):
+    def on_line(line):
+        if duration and line.startswith("out_time_us="):
+            try: report(stage, int(line.split("=", 1)[1]) / (duration * 1e6))
+            except ValueError: pass
+    return on_line
+
+def probe_duration(fp):
+    try: return float(run(f'ffprobe -v error -show_entries format=duration -of csv=p=0 "{fp}"'))
+    except (RuntimeError, ValueError, OSError): return None
+
+def yt_dlp_cmd():
     venv_yt_dlp = pathlib.Path(".venv/bin/yt-dlp")
-    if venv_yt_dlp.exists():
-        yt_dlp_cmd = str(venv_yt_dlp)
-    run(f'{yt_dlp_cmd} -f bestaudio -o "{out}" "{url}"')
-    return next(pathlib.Path(tmp).iterdir())
-
-def trans(src, fmt):
-    dst = DEST_DIR / f"{src.stem}.{fmt}"
-    if dst.exists(): dst.unlink()
-    opts = "-ac 2 -ar 44100" if fmt=="wav" else "-b:a 192k"
-    run(f'ffmpeg {FFMPEG_OPTS} -y -i "{src}" {opts} "{dst}"', quiet=True)
+    return str(venv_yt_dlp) if venv_yt_dlp.exists() else "yt-dlp"
+
+def video_info(url, work):
+    """yt-dlp's metadata for url (no download), also saved as work/info.json for --load-info-json"""
+    info_json = pathlib.Path(work) / "info.json"
+    info_json.write_text(run(f'{yt_dlp_cmd()} -f bestaudio --no-playlist -J "{url}"'))
+    return json.loads(info_json.read_text())
+
+@timed('download')
+def yank(url, tmp, on_progress=no_progress):
+    # The id keeps two videos with the same title apart
+    out = pathlib.Path(tmp) / "%(title)s [%(id)s].%(ext)s"
+    info_json = pathlib.Path(tmp) / "info.json"
+    src = f'--load-info-json "{info_json}"' if info_json.exists() else f'--no-playlist "{url}"'
+    run(f'{yt_dlp_cmd()} -f bestaudio {shlex.join(YTDLP_PROGRESS)} -o "{out}" {src}',
+        on_line=ytdlp_progress(on_progress))
+    raw = next(p for p in pathlib.Path(tmp).iterdir() if p != info_json)
+    count_bytes('out', raw)
+    return raw
+
+# Named encodings: preset -> (extension, ffmpeg options). Anything else is
+# encoded to its own name as an extension at 192k.
+TRANSCODE_PRESETS = {
+    'wav': ('wav', '-c:a pcm_s16le -ac 2 -ar 44100'),
+    'wav-48k': ('wav', '-c:a pcm_s16le -ac 2 -ar 48000'),
+    'wav-24bit': ('wav', '-c:a pcm_s24le -ac 2 -ar 48000'),
+    'flac': ('flac', '-c:a flac -ac 2 -ar 44100'),
+    'flac-48k': ('flac', '-c:a flac -ac 2 -ar 48000'),
+    'mp3': ('mp3', '-c:a libmp3lame -b:a 192k'),
+    'mp3-320k': ('mp3', '-c:a libmp3lame -b:a 320k'),
+    'opus': ('opus', '-c:a libopus -b:a 128k'),
+    'opus-96k': ('opus', '-c:a libopus -b:a 96k'),
+}
+
+def preset(name):
+    return TRANSCODE_PRESETS.get(name, (name, '-b:a 192k'))
+
+def encode_record(src, name):
+    """What an output was made from: the source file as it is now plus the preset's options"""
+    st = os.stat(src)
+    return {'src': str(pathlib.Path(src).resolve()), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+            'preset': name, 'options': preset(name)[1]}
+
+def record_path(dst):
+    return dst.with_name(f".{dst.name}.source.json")
+
+def transcode(src, dst, name, on_progress=no_progress, force=False):
+    """Encode src to dst with preset name, unless dst was already made from this src with this preset; returns whether it ran"""
+    src, dst = pathlib.Path(src), pathlib.Path(dst)
+    record = encode_record(src, name)
+    try:
+        fresh = not force and dst.exists() and json.loads(record_path(dst).read_text()) == record
+    except (OSError, ValueError):
+        fresh = False
+    cache_result('transcode', fresh)
+    if fresh:
+        return False
+    _encode(src, dst, name, on_progress)
+    record_path(dst).write_text(json.dumps(record))
+    return True
+
+@timed('transcode')
+def _encode(src, dst, name, on_progress):
+    count_bytes('in', src)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    part = dst.with_name(f".{uuid.uuid4().hex[:6]}{dst.suffix}")  # a partial file never looks up to date
+    try:
+        run(f'ffmpeg {FFMPEG_OPTS} -progress pipe:1 -nostats -y -i "{src}" -vn {preset(name)[1]} "{part}"', quiet=True,
+            on_line=ffmpeg_progress(on_progress, probe_duration(src)))
+        os.replace(part, dst)
+    finally:
+        part.unlink(missing_ok=True)
+    count_bytes('out', dst)
+
+def trans(src, fmt, on_progress=no_progress):
+    dst = DEST_DIR / f"{src.stem}.{preset(fmt)[0]}"
+    transcode(src, dst, fmt, on_progress, force=True)
+    return dst
+
+def expand_urls(urls):
+    """One {'url', 'title'} item per video for a mix of video and playlist URLs"""
+    items = []
+    for url in urls:
+        try:
+            info = json.loads(run(f'{yt_dlp_cmd()} --flat-playlist -J "{url}"'))
+        except (RuntimeError, ValueError) as e:
+            items.append({'url': url, 'error': str(e)})
+            continue
+        if info.get('entries') is None:
+            items.append({'url': info.get('webpage_url') or url, 'title': info.get('title')})
+        for entry in info.get('entries') or []:
+            if entry and (entry.get('url') or entry.get('webpage_url')):
+                items.append({'url': entry.get('webpage_url') or entry['url'], 'title': entry.get('title')})
+    return items
+
+@timed('stream_rip')
+def stream_rip(url, fmt, work, on_progress=no_progress):
+    """yt-dlp piped straight into ffmpeg; the encode overlaps the download and no raw copy hits disk"""
+    info_json = pathlib.Path(work) / "info.json"
+    info = json.loads(info_json.read_text()) if info_json.exists() else video_info(url, work)
+    ext, opts = preset(fmt)
+    dst = DEST_DIR / f"{yt_dlp.utils.sanitize_filename(info['title'])} [{info['id']}].{ext}"
+    part = dst.with_name(f".{dst.stem}.part.{ext}")
+
+    # Reuse the extracted info so yt-dlp doesn't hit the site twice. With -o -
+    # yt-dlp prints progress on stderr; ffmpeg reports on stdout via -progress.
+    dl = subprocess.Popen([yt_dlp_cmd(), "--load-info-json", str(info_json), "-f", "bestaudio",
+                           "--quiet", "--progress", *YTDLP_PROGRESS, "-o", "-"],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, errors="replace")
+    enc = subprocess.Popen(["ffmpeg", *shlex.split(FFMPEG_OPTS), "-progress", "pipe:1", "-nostats", "-y",
+                            "-i", "pipe:0", *shlex.split(opts), str(part)],
+                           stdin=dl.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, errors="replace")
+    dl.stdout.close()  # ffmpeg owns the read end now; lets yt-dlp see EPIPE if ffmpeg dies
+    dl_peak, enc_peak = watch_rss(dl.pid), watch_rss(enc.pid)
+    dl_lines, on_dl, start = [], ytdlp_progress(on_progress), time.time()
+    def drain_dl():
+        for line in dl.stderr:
+            dl_lines.append(line)
+            on_dl(line.strip())
+    reader = threading.Thread(target=drain_dl, daemon=True); reader.start()
+    on_enc = ffmpeg_progress(on_progress, info.get('duration'))
+    for line in enc.stdout:
+        on_enc(line.strip())
+    enc_err = enc.stderr.read()
+    reap(enc, "ffmpeg", start, enc_peak); reader.join(); reap(dl, yt_dlp_cmd(), start, dl_peak)
+    if dl.returncode or enc.returncode:
+        part.unlink(missing_ok=True)
+        raise RuntimeError(("".join(dl_lines[-20:]) if dl.returncode else enc_err) or f"rip failed: {url}")
+    os.replace(part, dst)
+    count_bytes('out', dst)
+    return dst
+
+@timed('separate')
+def run_demucs(fp, out, model="htdemucs", on_progress=no_progress, **opts):
+    require('separation')
+    count_bytes('in', fp)
+    SEPARATOR.separate(fp, out, model, on_progress=on_progress, **opts)
+    count_bytes('out', out)
+
+def split(fp, model="htdemucs", on_progress=no_progress, digest=None, **opts):
+    """Separate fp into stems, reusing cached stems for identical audio + settings"""
+    return STEM_CACHE.fetch(fp, model, opts, on_progress, digest)
+
+# === Chunked processing ===
+# Inputs longer than CHUNK_SECONDS are read in overlapping soundfile blocks,
+# processed one window at a time and written out incrementally, crossfading
+# across each overlap, so peak memory depends on the window, not the file.
+CHUNK_SECONDS = float(os.environ.get('L2W_CHUNK_SECONDS', 600))
+WINDOW_SECONDS = float(os.environ.get('L2W_WINDOW_SECONDS', 30))
+XFADE_SECONDS = float(os.environ.get('L2W_XFADE_SECONDS', 1))
+no_progress_frac = lambda frac: None
+
+def audio_seconds(fp):
+    try: return sf.info(str(fp)).duration
+    except Exception: return probe_duration(fp) or 0.0
+
+def as_pcm_wav(fp, work, sr=None, channels=None):
+    """fp if soundfile can read it as required, else an ffmpeg-decoded wav in work (on disk, not in RAM)"""
+    try:
+        info = sf.info(str(fp))
+        if sr in (None, info.samplerate) and channels in (None, info.channels):
+            return pathlib.Path(fp)
+    except RuntimeError:
+        pass
+    dst = pathlib.Path(work) / "decoded.wav"
+    opts = (f"-ar {sr} " if sr else "") + (f"-ac {channels} " if channels else "")
+    run(f'ffmpeg {FFMPEG_OPTS} -y -i "{fp}" {opts}-c:a pcm_f32le "{dst}"')
     return dst
 
-sha8 = lambda t: hashlib.md5(t.encode()).hexdigest()[:8]
-def split(fp, model="htdemucs"):
-    out = DEST_DIR/"stems"/sha8(fp); out.mkdir(parents=True, exist_ok=True)
-    dev = "--device=cuda" if torch.cuda.is_available() else "--device=cpu"
-    demucs.separate.main(["-n", model, dev, "-o", str(out), fp])
-    return {p.stem: p for p in out.glob("**/*.wav")}
+def process_windows(src, fn, writers, window, overlap, on_progress=no_progress_frac):
+    """Stream src through fn in overlapping windows, crossfading into writers.
+
+    fn(block) gets a (frames, channels) float32 array and returns {name: array}
+    of the same length; each array is appended to writers[name] (a SoundFile).
+    """
+    total = sf.info(str(src)).frames
+    tails, start = {}, 0
+    for block in sf.blocks(str(src), blocksize=window, overlap=overlap, always_2d=True, dtype='float32'):
+        last = start + len(block) >= total
+        for name, out in fn(block).items():
+            if name in tails:
+                n = min(len(tails[name]), len(out))
+                ramp = np.linspace(0, 1, n, dtype=out.dtype)[:, None]
+                out[:n] = tails[name][:n] * (1 - ramp) + out[:n] * ramp
+            if last:
+                writers[name].write(out)
+            else:
+                writers[name].write(out[:-overlap])
+                tails[name] = out[-overlap:].copy()
+        start += window - overlap
+        on_progress(min(1.0, start / max(total, 1)))
+        if last:
+            break
+
+# === Separation service ===
+# Models are loaded once per process and kept warm. Tracks queued at the same
+# time with the same model/options are padded into one batch and go through a
+# single demucs.apply.apply_model call.
+DEMUCS_DEFAULTS = {
+    'shifts': int(os.environ.get('L2W_DEMUCS_SHIFTS', 1)),
+    'overlap': float(os.environ.get('L2W_DEMUCS_OVERLAP', 0.25)),
+    'segment': float(os.environ['L2W_DEMUCS_SEGMENT']) if os.environ.get('L2W_DEMUCS_SEGMENT') else None,
+}
+DEMUCS_BATCH = int(os.environ.get('L2W_DEMUCS_BATCH', 4))
+# CPU only: >0 splits each track into segments separated in that many processes
+DEMUCS_PROCS = int(os.environ.get('L2W_DEMUCS_PROCS', 0))
+DEMUCS_PROC_SECONDS = float(os.environ.get('L2W_DEMUCS_PROC_SECONDS', 20))
+DEMUCS_BATCH_WAIT = float(os.environ.get('L2W_DEMUCS_BATCH_WAIT', 0.05))
+# Batched tracks are zero-padded to the longest, so only batch tracks within this length ratio
+DEMUCS_PAD_RATIO = float(os.environ.get('L2W_DEMUCS_PAD_RATIO', 1.5))
+
+_worker_models = {}
+
+def _segment_worker_init(threads):
+    # Pin torch's intra-op pool so N workers don't oversubscribe the cores
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+def _segment_worker(name, mix, opts):
+    """Separate one (channels, length) segment in a pool process, loading the model once per process"""
+    if name not in _worker_models:
+        _worker_models[name] = demucs.pretrained.get_model(name).eval()
+    kwargs = {k: v for k, v in opts.items() if v is not None}
+    with torch.no_grad():
+        out = demucs.apply.apply_model(_worker_models[name], torch.from_numpy(mix)[None], device="cpu", split=True, **kwargs)
+    return out[0].numpy()
+
+class SeparationService:
+    """Resident Demucs models plus a batching dispatcher thread"""
+    def __init__(self, batch=DEMUCS_BATCH, wait=DEMUCS_BATCH_WAIT, procs=DEMUCS_PROCS):
+        self.batch, self.wait = max(1, batch), wait
+        self._device = None
+        self.procs = procs
+        self.pool = None
+        self.models = {}
+        self.lock = threading.Lock()
+        self.q = queue.Queue()
+        self.pending = []
+        self.thread = None
+
+    @property
+    def device(self):
+        # Decided on first separation rather than at import, which would load torch
+        if self._device is None:
+            self._device = "cuda" if torch.cuda.is_available() else "cpu"
+        return self._device
+
+    def model(self, name):
+        """Load name on first use; later calls return the warm instance"""
+        with self.lock:
+            if name not in self.models:
+                m = demucs.pretrained.get_model(name)
+                m.to(self.device).eval()
+                m.name = name  # segment workers load their own copy by name
+                self.models[name] = m
+            return self.models[name]
+
+    def separate(self, fp, out, model="htdemucs", on_progress=no_progress, **opts):
+        """Write one wav per source into out; blocks until this track's batch is done"""
+        seconds = audio_seconds(fp)
+        req = {'fp': str(fp), 'out': pathlib.Path(out), 'model': model, 'opts': {**DEMUCS_DEFAULTS, **opts},
+               'on_progress': on_progress, 'fut': Future(), 'seconds': seconds,
+               # Long inputs are streamed through in windows instead of loaded whole
+               'chunked': seconds > CHUNK_SECONDS}
+        self._ensure_thread()
+        self.q.put(req)
+        return req['fut'].result()
+
+    def _ensure_thread(self):
+        with self.lock:
+            if not self.thread:
+                self.thread = threading.Thread(target=self._dispatch, name="demucs", daemon=True)
+                self.thread.start()
+
+    def _next_batch(self):
+        """First waiting request plus up to batch-1 others sharing its model and options and of similar length"""
+        if not self.pending:
+            self.pending.append(self.q.get())
+        deadline = time.monotonic() + self.wait
+        while True:
+            try:
+                self.pending.append(self.q.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        head = self.pending[0]
+        batch = [head]
+        if not head['chunked'] and head['seconds'] > 0:
+            # Closest lengths first, so a short clip never waits on (and pads to) a long track
+            alike = sorted((r for r in self.pending[1:] if not r['chunked'] and r['seconds'] > 0
+                            and (r['model'], r['opts']) == (head['model'], head['opts'])),
+                           key=lambda r: abs(r['seconds'] - head['seconds']))
+            for r in alike:
+                lengths = [b['seconds'] for b in batch] + [r['seconds']]
+                if len(batch) < self.batch and max(lengths) <= DEMUCS_PAD_RATIO * min(lengths):
+                    batch.append(r)
+        self.pending = [r for r in self.pending if not any(r is b for b in batch)]
+        return batch
+
+    def _dispatch(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                if batch[0]['chunked']:
+                    self._run_chunked(batch[0])
+                else:
+                    self._run(batch)
+            except Exception as e:
+                for r in batch:
+                    if not r['fut'].done(): r['fut'].set_exception(e)
+
+    def _apply(self, m, mix, opts, on_progress):
+        """apply_model on a (batch, channels, length) mix, reporting overall progress"""
+        if self.procs and self.device == "cpu":
+            return self._apply_parallel(m, mix, opts, on_progress)
+        kwargs = {k: v for k, v in opts.items() if v is not None}
+        length, passes = mix.shape[-1], max(1, opts.get('shifts') or 1)
+
+        def report(d):
+            # Called as each segment starts, per shift and per model in a bag
+            if d.get('state') == 'start':
+                on_progress((d['model_idx_in_bag'] + (d['shift_idx'] + d['segment_offset'] / length) / passes) / d['models'])
+
+        with torch.no_grad():
+            return demucs.apply.apply_model(m, mix, device=self.device, split=True, callback=report, **kwargs)
+
+    def _apply_parallel(self, m, mix, opts, on_progress):
+        """Overlapping segments separated across the process pool, then overlap-added"""
+        if not self.pool:
+            # spawn, not fork: this process has live threads and a torch runtime
+            self.pool = ProcessPoolExecutor(self.procs, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=_segment_worker_init,
+                                            initargs=(max(1, (os.cpu_count() or 1) // self.procs),))
+        seg = int(DEMUCS_PROC_SECONDS * m.samplerate)
+        fade = min(int(XFADE_SECONDS * m.samplerate), seg // 2)
+        batch, channels, length = mix.shape
+        starts = range(0, max(length - fade, 1), seg - fade)
+        futures = {self.pool.submit(_segment_worker, m.name, mix[b, :, s:s + seg].numpy(), opts): (b, s)
+                   for b in range(batch) for s in starts}
+        out = torch.zeros(batch, len(m.sources), channels, length)
+        weight = torch.zeros(batch, length)
+        ramp = torch.linspace(0, 1, fade + 2)[1:-1]
+        for done, fut in enumerate(as_completed(futures), 1):
+            b, s = futures[fut]
+            chunk = torch.from_numpy(fut.result())
+            n = chunk.shape[-1]
+            w = torch.ones(n)  # every segment is longer than fade, see starts above
+            if fade and s > 0: w[:fade] = ramp
+            if fade and s + n < length: w[-fade:] = ramp.flip(0)
+            out[b, ..., s:s + n] += chunk * w
+            weight[b, s:s + n] += w
+            on_progress(done / len(futures))
+        return out / weight[:, None, None, :]
+
+    def _run(self, batch):
+        m = self.model(batch[0]['model'])
+        # Decode each track on its own, so one unreadable upload fails only its caller
+        mixes, refs, ok = [], [], []
+        for r in batch:
+            try:
+                wav = demucs.audio.AudioFile(r['fp']).read(streams=0, samplerate=m.samplerate, channels=m.audio_channels)
+                if not wav.numel() or not torch.isfinite(wav).all():
+                    raise RuntimeError(f"no usable audio in {r['fp']}")
+            except Exception as e:
+                r['fut'].set_exception(e)
+                continue
+            ref = wav.mean(0)
+            mixes.append((wav - ref.mean()) / ref.std().clamp_min(1e-8))
+            refs.append(ref)
+            ok.append(r)
+        if not ok:
+            return
+        batch = ok
+        length = max(w.shape[-1] for w in mixes)
+        mix = torch.stack([torch.nn.functional.pad(w, (0, length - w.shape[-1])) for w in mixes])
+        sources = self._apply(m, mix, batch[0]['opts'],
+                              lambda frac: [r['on_progress']('separate', frac) for r in batch])
+        for r, src, ref, wav in zip(batch, sources, refs, mixes):
+            src = src[..., :wav.shape[-1]] * ref.std() + ref.mean()
+            r['out'].mkdir(parents=True, exist_ok=True)
+            for stem, audio in zip(m.sources, src):
+                demucs.audio.save_audio(audio.cpu(), str(r['out'] / f"{stem}.wav"), samplerate=m.samplerate)
+            r['fut'].set_result(r['out'])
+
+    def _run_chunked(self, req):
+        """Separate window by window so memory stays flat however long the input is"""
+        m = self.model(req['model'])
+        req['out'].mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory() as work:
+            src = as_pcm_wav(req['fp'], work, m.samplerate, m.audio_channels)
+            # Demucs normalizes by the whole track's mono mix; gather that in one streaming pass
+            n = total = total_sq = 0
+            for block in sf.blocks(str(src), blocksize=1 << 18, always_2d=True, dtype='float64'):
+                mono = block.mean(axis=1)
+                n, total, total_sq = n + len(mono), total + mono.sum(), total_sq + (mono ** 2).sum()
+            mean = total / max(n, 1)
+            std = max(np.sqrt(max(total_sq / max(n, 1) - mean ** 2, 0.0)), 1e-8)
+
+            def fn(block):
+                mix = (torch.from_numpy(block.T.copy()) - mean) / std
+                stems = self._apply(m, mix[None], req['opts'], no_progress_frac)[0] * std + mean
+                return {stem: s.T.cpu().numpy() for stem, s in zip(m.sources, stems)}
+
+            writers = {stem: sf.SoundFile(str(req['out'] / f"{stem}.wav"), 'w', m.samplerate, m.audio_channels,
+                                          subtype='PCM_16') for stem in m.sources}
+            try:
+                process_windows(src, fn, writers, int(WINDOW_SECONDS * m.samplerate),
+                                int(XFADE_SECONDS * m.samplerate), lambda frac: req['on_progress']('separate', frac))
+            finally:
+                for w in writers.values(): w.close()
+        req['fut'].set_result(req['out'])
+
+SEPARATOR = SeparationService()
+
+# === Stem cache ===
+# Stems live in DEST_DIR/stems/<key>, where key hashes the decoded audio plus
+# the model and Demucs options. An SQLite index tracks size and last access so
+# the directory can be kept under a disk budget by evicting least-recent sets.
+STEM_DIR = DEST_DIR / "stems"
+STEM_CACHE_BYTES = int(float(os.environ.get('L2W_STEM_CACHE_MB', 5000)) * 2**20)
+
+def audio_digest(fp):
+    """Hash of the decoded PCM, so the same audio at another path (or re-uploaded) matches"""
+    h = hashlib.blake2b(digest_size=16)
+    cmd = ["ffmpeg", *shlex.split(FFMPEG_OPTS), "-i", str(fp), "-f", "s16le", "-ac", "2", "-ar", "44100", "-"]
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    for chunk in iter(lambda: p.stdout.read(1 << 20), b""):
+        h.update(chunk)
+    err = p.stderr.read().decode(errors="replace")
+    if p.wait(): raise RuntimeError(err or f"could not decode {fp}")
+    return h.hexdigest()
 
-def rip_audio(url, fmt='mp3'):
+def dir_size(path):
+    return sum(f.stat().st_size for f in pathlib.Path(path).rglob("*") if f.is_file())
+
+def separation_settings(fp, model, opts):
+    """Everything besides the audio that shapes the stems: model, effective Demucs options, how the track is split"""
+    settings = {'model': model, **DEMUCS_DEFAULTS, **opts}
+    if DEMUCS_PROCS:
+        settings.update(proc_seconds=DEMUCS_PROC_SECONDS, xfade=XFADE_SECONDS)
+    if audio_seconds(fp) > CHUNK_SECONDS:
+        settings.update(window=WINDOW_SECONDS, xfade=XFADE_SECONDS)
+    return json.dumps(settings, sort_keys=True)
+
+class StemCache:
+    """Content-addressed stem sets with LRU eviction under a byte budget"""
+    def __init__(self, root, budget):
+        self.root = pathlib.Path(root); self.root.mkdir(parents=True, exist_ok=True)
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.db = sqlite3.connect(str(self.root / "index.sqlite3"), check_same_thread=False, isolation_level=None)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS stems (
+            key TEXT PRIMARY KEY, model TEXT, size INTEGER, created REAL, last_access REAL)""")
+        # File hash (from an upload) + settings -> key, so a known upload skips the decode
+        self.db.execute("""CREATE TABLE IF NOT EXISTS aliases (
+            digest TEXT, settings TEXT, key TEXT, PRIMARY KEY (digest, settings))""")
+
+    def key(self, fp, model, opts, digest=None):
+        settings = separation_settings(fp, model, opts)
+        if digest:
+            with self.lock:
+                row = self.db.execute("SELECT key FROM aliases WHERE digest = ? AND settings = ?",
+                                      (digest, settings)).fetchone()
+            if row:
+                return row[0]
+        key = hashlib.blake2b(f"{audio_digest(fp)}:{settings}".encode(), digest_size=12).hexdigest()
+        if digest:
+            with self.lock:
+                self.db.execute("INSERT OR REPLACE INTO aliases VALUES (?, ?, ?)", (digest, settings, key))
+        return key
+
+    def _key_lock(self, key):
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    def lookup(self, key):
+        """Stems for key, or None; a hit refreshes its last-access time"""
+        out = self.root / key
+        with self.lock:
+            row = self.db.execute("SELECT key FROM stems WHERE key = ?", (key,)).fetchone()
+            if row and not out.is_dir():
+                self.db.execute("DELETE FROM stems WHERE key = ?", (key,))
+                row = None
+            if row:
+                self.db.execute("UPDATE stems SET last_access = ? WHERE key = ?", (time.time(), key))
+        return {p.stem: p for p in out.glob("**/*.wav")} if row else None
+
+    def fetch(self, fp, model, opts, on_progress=no_progress, digest=None):
+        key = self.key(fp, model, opts, digest)
+        with self._key_lock(key):
+            stems = self.lookup(key)
+            cache_result('stems', bool(stems))
+            if stems:
+                return stems
+            # Build beside the cache and rename in, so readers never see half a set
+            out, build = self.root / key, self.root / f".build-{key}-{uuid.uuid4().hex[:6]}"
+            try:
+                run_demucs(fp, build, model, on_progress=on_progress, **opts)
+                shutil.rmtree(out, ignore_errors=True)
+                os.replace(build, out)
+            finally:
+                shutil.rmtree(build, ignore_errors=True)
+            now = time.time()
+            with self.lock:
+                self.db.execute("INSERT OR REPLACE INTO stems VALUES (?, ?, ?, ?, ?)",
+                                (key, model, dir_size(out), now, now))
+            self.evict(keep=key)
+            return self.lookup(key)
+
+    def evict(self, keep=None):
+        """Drop least-recently-used stem sets until the cache fits its budget"""
+        with self.lock:
+            total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM stems").fetchone()[0]
+            rows = self.db.execute("SELECT key, size FROM stems ORDER BY last_access").fetchall()
+            for key, size in rows:
+                if total <= self.budget:
+                    break
+                if key == keep:
+                    continue
+                shutil.rmtree(self.root / key, ignore_errors=True)
+                self.db.execute("DELETE FROM stems WHERE key = ?", (key,))
+                total -= size
+
+STEM_CACHE = StemCache(STEM_DIR, STEM_CACHE_BYTES)
+
+# === Rip library ===
+# Every finished rip is indexed by (extractor, video id, format), so ripping a
+# video we already have only costs a metadata probe, and listing or searching
+# the library is an indexed query instead of a directory scan.
+LIBRARY_DB = DEST_DIR / "library.sqlite3"
+
+class RipLibrary:
+    """SQLite index of ripped files keyed on the extractor's video id plus format"""
+    COLUMNS = ('extractor', 'video_id', 'format', 'title', 'uploader', 'duration', 'url', 'path', 'size', 'created')
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS rips (
+            extractor TEXT, video_id TEXT, format TEXT, title TEXT COLLATE NOCASE, uploader TEXT COLLATE NOCASE,
+            duration REAL, url TEXT, path TEXT, size INTEGER, created REAL,
+            PRIMARY KEY (extractor, video_id, format))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS rips_created ON rips (created)")
+
+    @staticmethod
+    def video(info):
+        """The parts of yt-dlp's info dict the library keeps"""
+        return {'extractor': info.get('extractor_key') or info.get('extractor') or 'generic',
+                'video_id': str(info['id']), 'title': info.get('title'), 'uploader': info.get('uploader'),
+                'duration': info.get('duration'), 'url': info.get('webpage_url') or info.get('original_url')}
+
+    def lookup(self, video, fmt):
+        """Path of an existing rip of this video in fmt, or None; rows whose file is gone are dropped"""
+        key = (video['extractor'], video['video_id'], fmt)
+        with self.lock:
+            row = self.db.execute("SELECT path FROM rips WHERE extractor = ? AND video_id = ? AND format = ?",
+                                  key).fetchone()
+            if row and not os.path.isfile(row['path']):
+                self.db.execute("DELETE FROM rips WHERE extractor = ? AND video_id = ? AND format = ?", key)
+                row = None
+        cache_result('library', bool(row))
+        return pathlib.Path(row['path']) if row else None
+
+    def add(self, video, fmt, path):
+        path = pathlib.Path(path)
+        row = {**video, 'format': fmt, 'path': str(path), 'size': path.stat().st_size, 'created': time.time()}
+        with self.lock:
+            self.db.execute(f"INSERT OR REPLACE INTO rips VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                            tuple(row[c] for c in self.COLUMNS))
+
+    def list(self, q=None, fmt=None, limit=50, offset=0):
+        """Newest-first rips whose title or uploader contains q, plus the total match count"""
+        where, args = [], []
+        if q:
+            where.append("(title LIKE ? OR uploader LIKE ?)")
+            args += [f"%{q}%"] * 2
+        if fmt:
+            where.append("format = ?")
+            args.append(fmt)
+        clause = f"WHERE {' AND '.join(where)}" if where else ""
+        with self.lock:
+            total = self.db.execute(f"SELECT COUNT(*) FROM rips {clause}", args).fetchone()[0]
+            rows = self.db.execute(f"SELECT * FROM rips {clause} ORDER BY created DESC LIMIT ? OFFSET ?",
+                                   (*args, limit, offset)).fetchall()
+        return [dict(r) for r in rows], total
+
+LIBRARY = RipLibrary(LIBRARY_DB)
+
+# === Uploads ===
+# Large files arrive in chunks: POST /uploads opens a session, each PUT appends
+# at the offset the server reports, and a dropped connection resumes from
+# there. Bytes stream straight into UPLOAD_DIR/partial while being hashed, and
+# the finished file is renamed to UPLOAD_DIR/<sha256>/<name>, so a repeated
+# upload is stored once and its hash is known before any decoding. Partial
+# uploads untouched for L2W_UPLOAD_TTL seconds are deleted, and finished ones
+# are evicted least-recently-used once they outgrow L2W_UPLOAD_CACHE_MB.
+UPLOAD_DIR = DEST_DIR / "uploads"
+UPLOAD_TTL = float(os.environ.get('L2W_UPLOAD_TTL', 86400))
+UPLOAD_CACHE_BYTES = int(float(os.environ.get('L2W_UPLOAD_CACHE_MB', 5000)) * 2**20)
+UPLOAD_MAX_BYTES = int(float(os.environ.get('L2W_UPLOAD_MAX_MB', 4096)) * 2**20)
+UPLOAD_LEASE = 300  # seconds before a chunk writer that stopped renewing (a dead worker) loses its claim
+
+class UploadError(Exception):
+    """A rejected upload request, with the HTTP status to answer it with"""
+    def __init__(self, message, code=400, **extra):
+        super().__init__(message)
+        self.code, self.extra = code, extra
+
+class UploadStore:
+    """Resumable, content-addressed uploads; session records live in SQLite so they survive a restart"""
+    def __init__(self, root, ttl=UPLOAD_TTL, budget=UPLOAD_CACHE_BYTES):
+        self.root, self.ttl, self.budget = pathlib.Path(root), ttl, budget
+        self.partial = self.root / "partial"; self.partial.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.hashes = {}  # upload id -> (running sha256, bytes it covers), for chunks this process wrote
+        self.swept = 0.0
+        self.sweeper = None
+        self.db = sqlite3.connect(str(self.root / "uploads.sqlite3"), check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        # writing: when the current chunk writer last renewed its claim, shared by every worker process
+        self.db.execute("""CREATE TABLE IF NOT EXISTS uploads (
+            id TEXT PRIMARY KEY, filename TEXT, size INTEGER, sha256 TEXT, created REAL, updated REAL, writing REAL)""")
+        try:
+            self.db.execute("ALTER TABLE uploads ADD COLUMN writing REAL")
+        except sqlite3.OperationalError:
+            pass  # already there
+
+    @staticmethod
+    def clean_name(filename):
+        name = os.path.basename(str(filename or '').replace('\\', '/')).strip()
+        name = ''.join('_' if c in '<>:"|?*' or ord(c) < 32 else c for c in name)
+        return name if name.strip('.') else 'upload'
+
+    def find(self, digest):
+        """The stored file for a sha256, or None; a hit counts as a fresh access for eviction"""
+        if len(digest) != 64 or set(digest) - set('0123456789abcdef'):
+            return None
+        folder = self.root / digest
+        if not folder.is_dir():
+            return None
+        path = next((f for f in folder.iterdir() if f.is_file()), None)
+        if path:
+            os.utime(folder)
+        return path
+
+    def create(self, filename, size, sha256=None):
+        """Open a session, or return the stored file straight away when its sha256 is already known"""
+        self.sweep()
+        if not isinstance(size, int) or not 0 < size <= UPLOAD_MAX_BYTES:
+            raise UploadError(f'size must be between 1 and {UPLOAD_MAX_BYTES} bytes')
+        sha256 = sha256.lower() if isinstance(sha256, str) else None
+        known = sha256 and self.find(sha256)
+        cache_result('upload', bool(known))
+        if known:
+            return {'status': 'complete', 'digest': sha256, 'filename': known.name, 'filepath': str(known)}
+        upload_id, now = uuid.uuid4().hex, time.time()
+        (self.partial / upload_id).touch()
+        with self.lock:
+            self.hashes[upload_id] = (hashlib.sha256(), 0)
+            self.db.execute("INSERT INTO uploads VALUES (?, ?, ?, ?, ?, ?, NULL)",
+                            (upload_id, self.clean_name(filename), size, sha256, now, now))
+        return {'status': 'uploading', 'upload_id': upload_id, 'offset': 0, 'size': size}
+
+    def get(self, upload_id):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM uploads WHERE id = ?", (upload_id,)).fetchone()
+        if not row:
+            raise UploadError('Upload not found', 404)
+        part = self.partial / upload_id
+        return {**dict(row), 'offset': part.stat().st_size if part.exists() else 0}
+
+    def status(self, upload_id):
+        up = self.get(upload_id)
+        return {'status': 'uploading', 'upload_id': upload_id, 'offset': up['offset'], 'size': up['size']}
+
+    def _hash(self, upload_id, part, offset):
+        """Running hash of the partial's first offset bytes; re-read from disk unless this process's copy
+        covers exactly that much (another worker may have appended chunks since)"""
+        h, covered = self.hashes.get(upload_id, (None, -1))
+        if covered == offset:
+            return h
+        h, left = hashlib.sha256(), offset
+        with open(part, 'rb') as f:
+            for block in iter(lambda: f.read(min(1 << 20, left)), b''):
+                h.update(block)
+                left -= len(block)
+        return h
+
+    def _claim(self, upload_id):
+        """Become the one writer of this upload across all processes, or raise 409"""
+        now = time.time()
+        with self.lock:
+            cur = self.db.execute("UPDATE uploads SET writing = ? WHERE id = ? AND (writing IS NULL OR writing < ?)",
+                                  (now, upload_id, now - UPLOAD_LEASE))
+        if cur.rowcount != 1:
+            self.get(upload_id)  # 404 for an unknown upload
+            raise UploadError('Another chunk of this upload is in progress', 409)
+
+    def write(self, upload_id, offset, stream, length=None):
+        """Append a chunk at offset (which must equal the bytes already received); finishes the upload when full"""
+        self._claim(upload_id)
+        try:
+            up = self.get(upload_id)
+            if offset != up['offset']:
+                raise UploadError('Offset does not match the bytes received', 409, offset=up['offset'])
+            if length is not None and length > up['size'] - offset:
+                raise UploadError(f"Chunk runs past the declared size ({up['size'] - offset} bytes left)", 413)
+            received, h = self._append(up, stream)
+            if offset + received < up['size']:
+                return {'status': 'uploading', 'upload_id': upload_id, 'offset': offset + received, 'size': up['size']}
+            return self._finish(up, self.partial / upload_id, h.hexdigest())
+        finally:
+            with self.lock:
+                self.db.execute("UPDATE uploads SET writing = NULL WHERE id = ?", (upload_id,))
+
+    @timed('upload')
+    def _append(self, up, stream):
+        """Stream the request body onto the partial file, at most up to the declared size"""
+        part = self.partial / up['id']
+        h = self._hash(up['id'], part, up['offset'])
+        remaining, received = up['size'] - up['offset'], 0
+        renewed = time.time()
+        try:
+            with open(part, 'ab') as f:
+                # A body cut off mid-chunk just leaves a shorter partial to resume from
+                for block in iter(lambda: stream.read(min(1 << 20, remaining - received)), b''):
+                    f.write(block); h.update(block)
+                    received += len(block)
+                    if received == remaining:
+                        break
+                    if time.time() - renewed > UPLOAD_LEASE / 10:  # a slow chunk keeps its claim
+                        renewed = time.time()
+                        with self.lock:
+                            self.db.execute("UPDATE uploads SET writing = ? WHERE id = ?", (renewed, up['id']))
+        finally:
+            with self.lock:
+                self.hashes[up['id']] = (h, up['offset'] + received)
+                self.db.execute("UPDATE uploads SET updated = ? WHERE id = ?", (time.time(), up['id']))
+            METRICS.inc('l2w_bytes_total', received, stage='upload', direction='in')
+        return received, h
+
+    def _finish(self, up, part, digest):
+        self._forget(up['id'])
+        if up['sha256'] and up['sha256'] != digest:
+            part.unlink(missing_ok=True)
+            raise UploadError('Upload does not match its sha256', 422)
+        folder = self.root / digest
+        path = self.find(digest)
+        if path:
+            part.unlink(missing_ok=True)  # someone uploaded the same bytes first
+        else:
+            folder.mkdir(exist_ok=True)
+            path = folder / up['filename']
+            os.replace(part, path)
+        self.sweep(force=True, keep=folder)
+        return {'status': 'complete', 'digest': digest, 'filename': path.name, 'filepath': str(path)}
+
+    @timed('upload')
+    def ingest(self, fileobj, filename):
+        """Store a whole file object (a plain form upload) the same way, in one pass"""
+        h = hashlib.sha256()
+        part = self.partial / uuid.uuid4().hex
+        with open(part, 'wb') as f:
+            for block in iter(lambda: fileobj.read(1 << 20), b''):
+                f.write(block); h.update(block)
+        count_bytes('in', part)
+        up = {'id': part.name, 'filename': self.clean_name(filename), 'sha256': None}
+        return self._finish(up, part, h.hexdigest())
+
+    def _forget(self, upload_id):
+        with self.lock:
+            self.hashes.pop(upload_id, None)
+            self.db.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+
+    def abort(self, upload_id):
+        self.get(upload_id)
+        self._forget(upload_id)
+        (self.partial / upload_id).unlink(missing_ok=True)
+
+    def start_sweeper(self):
+        # Abandoned partials expire on a timer, not only when the next upload arrives
+        with self.lock:
+            if not self.sweeper:
+                self.sweeper = every(min(60, max(self.ttl, 1)), lambda: self.sweep(force=True), "upload-sweep")
+
+    def sweep(self, force=False, keep=None):
+        """Drop partial uploads idle past the TTL, then least-recently-used stored files over budget"""
+        now = time.time()
+        if not force and now - self.swept < 60:
+            return
+        self.swept = now
+        active = "updated > ? OR writing > ?", (now - self.ttl, now - UPLOAD_LEASE)
+        with self.lock:
+            live = {r['id'] for r in self.db.execute(f"SELECT id FROM uploads WHERE {active[0]}", active[1])}
+        for part in self.partial.iterdir():
+            if part.name in live:
+                continue
+            try:
+                if now - part.stat().st_mtime > self.ttl:
+                    self._forget(part.name)
+                    part.unlink(missing_ok=True)
+            except FileNotFoundError:
+                pass
+        with self.lock:  # sessions whose partial file has already gone
+            self.db.execute(f"DELETE FROM uploads WHERE NOT ({active[0]})", active[1])
+        folders = [(f.stat().st_mtime, dir_size(f), f) for f in self.root.iterdir()
+                   if f.is_dir() and f != self.partial]
+        total = sum(size for _, size, _ in folders)
+        for _, size, f in sorted(folders, key=lambda t: t[0]):
+            if total <= self.budget:
+                break
+            if f != keep:
+                shutil.rmtree(f, ignore_errors=True)
+                total -= size
+
+UPLOADS = UploadStore(UPLOAD_DIR)
+
+def rip_audio(url, fmt='mp3', stream=None):
     """Download audio from YouTube and convert to specified format"""
-    global LAST_RIP, PROCESSING
-    PROCESSING = True
+    global LAST_RIP
+    stream = STREAM_RIPS if stream is None else stream
+    with tempfile.TemporaryDirectory() as tmp:
+        video = LIBRARY.video(video_info(url, tmp))
+        out = LIBRARY.lookup(video, fmt)
+        if not out:
+            out = stream_rip(url, fmt, tmp) if stream else trans(yank(url, tmp), fmt)
+            LIBRARY.add(video, fmt, out)
+        LAST_RIP = str(out)
+        return str(out)
+
+def separate_audio(audio_file, on_progress=no_progress, digest=None):
+    """Separate audio into stems"""
+    global CURRENT_STEMS
+    p = pathlib.Path(audio_file)
+    if not p.exists():
+        return None
     
+    stems = split(str(p), on_progress=on_progress, digest=digest)
+    CURRENT_STEMS = stems
+    return stems
+
+# === Job subsystem ===
+# Every rip/separation is a job with an ID, persisted in SQLite and executed
+# stage by stage on per-resource worker pools, so a long Demucs run no longer
+# blocks downloads and each client polls its own result.
+JOBS_DB = DEST_DIR / "jobs.sqlite3"
+WORK_DIR = DEST_DIR / "work"
+POOL_SIZES = {
+    'download': int(os.environ.get('L2W_DOWNLOAD_WORKERS', 4)),
+    'transcode': int(os.environ.get('L2W_TRANSCODE_WORKERS', os.cpu_count() or 2)),
+    # Separation workers mostly wait on the batching SeparationService below
+    'separate': int(os.environ.get('L2W_SEPARATE_WORKERS', os.environ.get('L2W_DEMUCS_BATCH', 4))),
+    # Playlist and export expansion; they feed other pools, so must not run on them
+    'batch': int(os.environ.get('L2W_BATCH_WORKERS', 2)),
+    # Sidecar analysis after each rip and separation
+    'analysis': int(os.environ.get('L2W_ANALYSIS_WORKERS', 2)),
+}
+BATCH_LIMIT = int(os.environ.get('L2W_BATCH_LIMIT', 500))
+QUEUE_LIMIT = int(os.environ.get('L2W_QUEUE_LIMIT', 64))
+
+class JobStore:
+    """Job records in a small SQLite file so queued work survives a restart"""
+    JSON_FIELDS = ('params', 'state', 'result')
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY, kind TEXT, status TEXT, stage INTEGER, owner INTEGER,
+            params TEXT, state TEXT, result TEXT, error TEXT, created REAL, updated REAL)""")
+        self.db.execute("CREATE TABLE IF NOT EXISTS traces (job_id TEXT, events TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS traces_job ON traces (job_id)")
+
+    def create(self, kind, params):
+        job_id = uuid.uuid4().hex[:12]
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT INTO jobs VALUES (?, ?, 'queued', 0, ?, ?, '{}', NULL, NULL, ?, ?)",
+                            (job_id, kind, os.getpid(), json.dumps(params), now, now))
+        return job_id
+
+    def update(self, job_id, **fields):
+        fields = {k: json.dumps(v) if k in self.JSON_FIELDS else v for k, v in fields.items()}
+        fields['updated'] = time.time()
+        cols = ", ".join(f"{k} = ?" for k in fields)
+        with self.lock:
+            self.db.execute(f"UPDATE jobs SET {cols} WHERE id = ?", (*fields.values(), job_id))
+
+    def claim(self, job_id, old_owner):
+        """Take over a job left behind by a dead process; False if someone beat us to it"""
+        with self.lock:
+            cur = self.db.execute("UPDATE jobs SET owner = ? WHERE id = ? AND owner = ?",
+                                  (os.getpid(), job_id, old_owner))
+        return cur.rowcount == 1
+
+    def _row(self, row):
+        job = dict(row)
+        for k in self.JSON_FIELDS:
+            job[k] = json.loads(job[k]) if job[k] else None
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row(row) if row else None
+
+    def list(self, limit=50):
+        with self.lock:
+            rows = self.db.execute("SELECT * FROM jobs ORDER BY created DESC LIMIT ?", (limit,)).fetchall()
+        return [self._row(r) for r in rows]
+
+    def unfinished(self):
+        with self.lock:
+            rows = self.db.execute("SELECT * FROM jobs WHERE status IN ('queued', 'running')").fetchall()
+        return [self._row(r) for r in rows]
+
+    def children(self, parent_id):
+        with self.lock:
+            rows = self.db.execute("SELECT * FROM jobs WHERE json_extract(params, '$.parent') = ? ORDER BY created",
+                                   (parent_id,)).fetchall()
+        return [self._row(r) for r in rows]
+
+    def add_trace(self, job_id, events):
+        with self.lock:
+            self.db.execute("INSERT INTO traces VALUES (?, ?)", (job_id, json.dumps(events)))
+
+    def trace(self, job_id):
+        """Every traced event of a job, in the order its stages ran"""
+        with self.lock:
+            rows = self.db.execute("SELECT events FROM traces WHERE job_id = ? ORDER BY rowid", (job_id,)).fetchall()
+        return [event for (events,) in rows for event in json.loads(events)]
+
+    def status_counts(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def active_count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+
+class WorkerPool:
+    """Fixed set of daemon threads draining a bounded queue"""
+    def __init__(self, name, workers, limit=QUEUE_LIMIT):
+        self.name = name
+        self.q = queue.Queue(limit)
+        for i in range(max(1, workers)):
+            threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True).start()
+
+    def submit(self, fn, *args, block=False):
+        self.q.put((fn, args), block=block)  # queue.Full when saturated and not blocking
+
+    def _work(self):
+        while True:
+            fn, args = self.q.get()
+            try:
+                fn(*args)
+            except Exception:
+                log.exception("[%s] worker error", self.name)
+            finally:
+                self.q.task_done()
+
+def _owner_alive(pid):
+    if pid == os.getpid():
+        return True
     try:
-        with tempfile.TemporaryDirectory() as tmp:
-            raw = yank(url, tmp)
-            out = trans(raw, fmt)
+        os.kill(pid, 0)
+        return True
+    except (OSError, TypeError):
+        return False
+
+class EventBus:
+    """Fan-out of job events to stream subscribers; publishing never waits on a slow client"""
+    def __init__(self, backlog=256):
+        self.backlog = backlog
+        self.lock = threading.Lock()
+        self.subs = {}  # job id, or '*' for every job -> set of queues
+
+    def subscribe(self, key):
+        q = queue.Queue(self.backlog)
+        with self.lock:
+            self.subs.setdefault(key, set()).add(q)
+        return q
+
+    def unsubscribe(self, key, q):
+        with self.lock:
+            self.subs.get(key, set()).discard(q)
+            if not self.subs.get(key):
+                self.subs.pop(key, None)
+
+    def publish(self, job_id, event):
+        event = {'job': job_id, **event}
+        with self.lock:
+            targets = [*self.subs.get(job_id, ()), *self.subs.get('*', ())]
+        for q in targets:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                pass  # a stalled subscriber misses progress ticks, not the pipeline
+
+EVENTS = EventBus()
+
+def progress_reporter(job_id):
+    """report(stage, fraction) that publishes at most one event per whole percent"""
+    last = {}
+    def report(stage, frac):
+        pct = int(min(max(frac, 0.0), 1.0) * 100)
+        if last.get(stage) != pct:
+            last[stage] = pct
+            EVENTS.publish(job_id, {'type': 'progress', 'stage': stage, 'percent': pct})
+    return report
+
+# Stage functions take (job_id, params, state) and return the new state; the
+# state returned by the last stage becomes the job's result.
+def library_hit(params, work):
+    """Probe the video; returns (library video record, existing rip or None)"""
+    video = LIBRARY.video(video_info(params['url'], work))
+    return video, LIBRARY.lookup(video, params.get('format', 'mp3'))
+
+def stage_download(job_id, params, state):
+    work = WORK_DIR / job_id; work.mkdir(parents=True, exist_ok=True)
+    video, hit = library_hit(params, work)
+    if hit:
+        # Already ripped in this format: the transcode stage just passes it through
+        shutil.rmtree(work, ignore_errors=True)
+        return {'filename': hit.name, 'filepath': str(hit), 'cached': True}
+    return {'raw': str(yank(params['url'], work, progress_reporter(job_id))), 'video': video}
+
+def stage_transcode(job_id, params, state):
+    global LAST_RIP
+    if 'filepath' in state:
+        LAST_RIP = state['filepath']
+        return state
+    fmt = params.get('format', 'mp3')
+    out = trans(pathlib.Path(state['raw']), fmt, progress_reporter(job_id))
+    shutil.rmtree(WORK_DIR / job_id, ignore_errors=True)
+    LIBRARY.add(state['video'], fmt, out)
+    LAST_RIP = str(out)
+    return {'filename': out.name, 'filepath': str(out)}
+
+def stage_stream_rip(job_id, params, state):
+    global LAST_RIP
+    work = WORK_DIR / job_id; work.mkdir(parents=True, exist_ok=True)
+    fmt = params.get('format', 'mp3')
+    try:
+        video, out = library_hit(params, work)
+        if out:
             LAST_RIP = str(out)
-            PROCESSING = False
-            return str(out)
+            return {'filename': out.name, 'filepath': str(out), 'cached': True}
+        out = stream_rip(params['url'], fmt, work, progress_reporter(job_id))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    LIBRARY.add(video, fmt, out)
+    LAST_RIP = str(out)
+    return {'filename': out.name, 'filepath': str(out)}
+
+def stage_separate(job_id, params, state):
+    stems = separate_audio(params['filepath'], progress_reporter(job_id), params.get('digest'))
+    if not stems:
+        raise RuntimeError('Separation failed')
+    return {'stems': [{'name': name, 'path': str(path)} for name, path in stems.items()]}
+
+def output_paths(result):
+    """Audio files a finished rip or separation produced"""
+    return [result['filepath']] if 'filepath' in result else [s['path'] for s in result.get('stems', [])]
+
+def stage_analyze(job_id, params, state):
+    """Write analysis sidecars for another job's outputs; a failure of one file never fails the rest"""
+    paths = params['paths']
+    report = progress_reporter(job_id)
+    for i, path in enumerate(paths):
+        try:
+            analyze_file(path)
+        except Exception as e:
+            log.warning("analysis of %s failed", path, exc_info=True)
+            trace_event(type='error', name='analysis', start=time.time(), path=path, error=str(e),
+                        traceback=traceback.format_exc())
+        report('analysis', (i + 1) / len(paths))
+    return state
+
+def submit_children(job_id, kind, items, child_params):
+    """Submit a child job per item; children left by an interrupted run (matched by item index) are reused"""
+    # The item list is saved first, so a resumed run maps onto the same indexes
+    JOBS.update(job_id, state={'items': items})
+    existing = {c['params'].get('item'): c['id'] for c in JOBS.children(job_id)}
+    for i, item in enumerate(items):
+        if 'error' not in item:
+            item['job_id'] = existing.get(i) or submit_job(kind, block=True, parent=job_id, item=i, **child_params(item))
+    # 'waiting' keeps the batch running until _finish_batch sees every child finish
+    return {'items': items, 'waiting': True}
+
+def stage_expand(job_id, params, state):
+    if state.get('waiting'):
+        return state  # resumed after a restart; every child already exists
+    kind = 'rip-stream' if params.get('stream', STREAM_RIPS) else 'rip'
+    items = state.get('items') or expand_urls(params['urls'])[:BATCH_LIMIT]
+    return submit_children(job_id, kind, items,
+                           lambda item: {'url': item['url'], 'format': params.get('format', 'mp3')})
+
+def export_dir(src):
+    """exports/<folder>-<hash>: one directory per source folder, so every song's vocals.wav stays apart"""
+    folder = pathlib.Path(src).resolve().parent
+    return DEST_DIR / "exports" / f"{folder.name}-{hashlib.blake2b(str(folder).encode(), digest_size=4).hexdigest()}"
+
+def export_path(src, name, out_dir):
+    """Where an export of src with preset name goes: <stem>.<ext>, or <stem>-<preset>.<ext> for variants"""
+    ext = preset(name)[0]
+    return pathlib.Path(out_dir) / (f"{src.stem}.{ext}" if name == ext else f"{src.stem}-{name}.{ext}")
+
+def stage_export(job_id, params, state):
+    if state.get('waiting'):
+        return state  # resumed after a restart; every child already exists
+    items = state.get('items') or [
+        {'src': src, 'preset': name,
+         'filepath': str(export_path(pathlib.Path(src), name, params.get('dest') or export_dir(src)))}
+        for src in params['files'] for name in params['presets']][:BATCH_LIMIT]
+    return submit_children(job_id, 'convert', items,
+                           lambda item: {k: item[k] for k in ('src', 'preset', 'filepath')})
+
+def stage_convert(job_id, params, state):
+    ran = transcode(params['src'], params['filepath'], params['preset'], progress_reporter(job_id))
+    return {'filename': os.path.basename(params['filepath']), 'filepath': params['filepath'], 'skipped': not ran}
+
+JOB_STAGES = {
+    'rip': [('download', stage_download), ('transcode', stage_transcode)],
+    'rip-stream': [('download', stage_stream_rip)],
+    'separate': [('separate', stage_separate)],
+    # Queued once a rip or separation is done, so its result never waits on analysis
+    'analyze': [('analysis', stage_analyze)],
+    'batch': [('batch', stage_expand)],
+    'export': [('batch', stage_export)],
+    'convert': [('transcode', stage_convert)],
+}
+
+JOBS = JobStore(JOBS_DB)
+METRICS.collectors.append(lambda: [
+    *(('l2w_queue_depth', {'pool': name}, pool.q.qsize()) for name, pool in POOLS.items()),
+    *(('l2w_jobs', {'status': status}, n) for status, n in JOBS.status_counts().items()),
+    ('l2w_process_max_rss_bytes', {}, process_peak_rss()),
+])
+POOLS = {}
+_pools_lock = threading.Lock()
+
+def start_workers():
+    """Spin up the worker pools once per process and pick up orphaned jobs"""
+    with _pools_lock:
+        if POOLS:
+            return
+        for name, size in POOL_SIZES.items():
+            POOLS[name] = WorkerPool(name, size)
+    UPLOADS.start_sweeper()
+    every(60, sweep_previews, "preview-sweep")
+    for job in JOBS.unfinished():
+        if not _owner_alive(job['owner']) and JOBS.claim(job['id'], job['owner']):
+            _set_job(job['id'], status='queued')
+            _enqueue(job['id'], job['kind'], job['stage'], block=True)
+
+def _enqueue(job_id, kind, stage, block=False):
+    pool = JOB_STAGES[kind][stage][0]
+    try:
+        POOLS[pool].submit(_run_stage, job_id, kind, stage, block=block)
+    except queue.Full:
+        _set_job(job_id, status='error', error=f'The {pool} queue is full, try again later')
+        raise
+
+def _run_stage(job_id, kind, stage):
+    job = JOBS.get(job_id)
+    stages = JOB_STAGES[kind]
+    name = stages[stage][0]
+    start = time.time()
+    METRICS.observe('l2w_queue_wait_seconds', start - job['updated'], pool=name)
+    _set_job(job_id, status='running', stage=stage)
+    _trace.events = [] if TRACE_JOBS else None
+    error = tb = None
+    try:
+        state = stages[stage][1](job_id, job['params'], job['state'] or {})
     except Exception as e:
-        PROCESSING = False 
-        raise e
+        error, tb = str(e), traceback.format_exc()
+        log.error("job %s failed in %s stage", job_id, name, exc_info=True)
+    finally:
+        seconds = time.time() - start
+        METRICS.observe('l2w_job_stage_seconds', seconds, kind=kind, stage=name)
+        # A failure's traceback is always kept in the trace, even with tracing off
+        if _trace.events is not None or tb:
+            event = {'type': 'stage', 'name': name, 'start': start, 'seconds': round(seconds, 4),
+                     'queued_seconds': round(start - job['updated'], 4), 'ok': error is None}
+            if tb:
+                event.update(error=error, traceback=tb)
+            JOBS.add_trace(job_id, [event, *sorted(_trace.events or [], key=lambda e: e['start'])])
+        _trace.events = None
+    if error is not None:
+        shutil.rmtree(WORK_DIR / job_id, ignore_errors=True)
+        _set_job(job_id, status='error', error=error)
+        _finish_batch(job['params'].get('parent'))
+        return
+    if stage + 1 < len(stages):
+        _set_job(job_id, status='queued', stage=stage + 1, state=state)
+        _enqueue(job_id, kind, stage + 1, block=True)
+    elif state.get('waiting'):
+        _set_job(job_id, state=state)
+        _finish_batch(job_id)
+    else:
+        _set_job(job_id, status='done', state=state, result=state)
+        _finish_batch(job['params'].get('parent'))
+        if kind in ANALYZED_KINDS:
+            analyze_later(job_id, output_paths(state))
 
-def separate_audio(audio_file):
-    """Separate audio into stems"""
-    global CURRENT_STEMS, PROCESSING
-    PROCESSING = True
-    
+ANALYZED_KINDS = ('rip', 'rip-stream', 'separate')
+
+def analyze_later(job_id, paths):
+    """Queue sidecar analysis of a finished job's outputs; skipped (GET /analysis fills in) when saturated"""
     try:
-        p = pathlib.Path(audio_file)
-        if not p.exists():
-            PROCESSING = False
+        submit_job('analyze', source=job_id, paths=paths)
+    except queue.Full:
+        log.warning("analysis queue full; skipping sidecars for job %s", job_id)
+
+_batch_lock = threading.Lock()
+
+def _finish_batch(batch_id):
+    """Report a batch's progress and close it out once none of its children are pending"""
+    if not batch_id:
+        return
+    with _batch_lock:
+        batch = JOBS.get(batch_id)
+        if not batch or batch['status'] != 'running' or not (batch['state'] or {}).get('waiting'):
+            return
+        children = {c['id']: c for c in JOBS.children(batch_id)}
+        items = batch['state']['items']
+        finished = [c for c in children.values() if c['status'] in ('done', 'error')]
+        EVENTS.publish(batch_id, {'type': 'progress', 'stage': 'batch',
+                                  'percent': int(100 * len(finished) / max(1, len(children)))})
+        if len(finished) < len(children):
+            return
+        for item in items:
+            child = children.get(item.get('job_id'))
+            if child:
+                item.update(status=child['status'], error=child['error'], **(child['result'] or {}))
+            else:
+                item['status'] = 'error'
+        _set_job(batch_id, status='done', state={'items': items}, result={'items': items})
+
+def _set_job(job_id, **fields):
+    """Persist a job change and tell its subscribers"""
+    JOBS.update(job_id, **fields)
+    EVENTS.publish(job_id, {'type': 'status', **public_job(JOBS.get(job_id))})
+
+def submit_job(kind, block=False, **params):
+    """Record a new job and queue its first stage; raises queue.Full when saturated"""
+    start_workers()
+    job_id = JOBS.create(kind, params)
+    _enqueue(job_id, kind, 0, block=block)
+    return job_id
+
+@app.before_request
+def _ensure_workers():
+    # Lazily, so the reloader's parent process never runs jobs
+    if not POOLS:
+        start_workers()
+
+def public_job(job):
+    """The parts of a job record that clients see"""
+    return {k: job[k] for k in ('id', 'kind', 'status', 'result', 'error', 'created', 'updated')}
+
+# === Autotune engine ===
+# Scale degrees as semitones above the tonic (C major). The trailing 12 lets
+# pitches just under the next C snap upward instead of wrapping to B.
+C_MAJOR_STEPS = np.array([0, 2, 4, 5, 7, 9, 11, 12])
+AT_FRAME, AT_HOP = 2048, 512
+
+def detect_pitch(y, sr, frame_length=AT_FRAME, hop_length=AT_HOP):
+    """Most prominent pitch per frame in Hz (0 where unpitched), one piptrack pass"""
+    pitches, magnitudes = librosa.piptrack(y=y, sr=sr, n_fft=frame_length, hop_length=hop_length)
+    return pitches[magnitudes.argmax(axis=0), np.arange(pitches.shape[1])]
+
+def snap_to_scale(f0, steps=C_MAJOR_STEPS):
+    """Semitones needed to move each frame of f0 onto the nearest scale note"""
+    voiced = f0 > 0
+    midi = np.zeros_like(f0)
+    midi[voiced] = 12 * np.log2(f0[voiced] / 440.0) + 69
+    octave, pc = np.divmod(midi, 12)
+    nearest = steps[np.abs(pc[:, None] - steps[None, :]).argmin(axis=1)]
+    return np.where(voiced, nearest + 12 * octave - midi, 0.0)
+
+def shift_curve(y, semitones, n_fft=AT_FRAME, hop_length=AT_HOP):
+    """Phase-vocoder pitch shift driven by a per-frame semitone curve"""
+    S = librosa.stft(y, n_fft=n_fft, hop_length=hop_length)
+    n_bins, n_frames = S.shape
+    semitones = np.pad(semitones, (0, max(0, n_frames - len(semitones))))[:n_frames]
+    ratio = 2.0 ** (semitones / 12.0)
+
+    # True phase advance per hop for every bin (standard phase vocoder)
+    mag, phase = np.abs(S), np.angle(S)
+    omega = 2 * np.pi * hop_length * np.arange(n_bins) / n_fft
+    dphi = np.diff(phase, axis=1, prepend=phase[:, :1]) - omega[:, None]
+    dphi -= 2 * np.pi * np.round(dphi / (2 * np.pi))
+    advance = omega[:, None] + dphi
+    advance[:, 0] = phase[:, 0]
+
+    # Move every bin to k * ratio in its frame, scaling its frequency with it
+    target = np.rint(np.arange(n_bins)[:, None] * ratio[None, :]).astype(np.int64)
+    cols = np.broadcast_to(np.arange(n_frames), target.shape)
+    keep = target < n_bins
+    flat = target[keep] * n_frames + cols[keep]
+    out_mag = np.bincount(flat, weights=mag[keep], minlength=S.size).reshape(S.shape)
+    out_adv = np.zeros(S.shape)
+    out_adv.flat[flat] = (advance * ratio[None, :])[keep]
+
+    out_phase = np.cumsum(out_adv, axis=1)
+    return librosa.istft(out_mag * np.exp(1j * out_phase), hop_length=hop_length, length=len(y))
+
+def autotune(y, sr, strength=1.0, f0=None):
+    """Snap y to C major: one pitch-tracking pass (skipped if f0 is given), one batched resynthesis"""
+    semitones = snap_to_scale(detect_pitch(y, sr) if f0 is None else f0) * strength
+    if not semitones.any():
+        return y.copy()
+    return shift_curve(y, semitones)
+
+# === Analysis sidecars ===
+# Every rip and stem gets <file>.analysis.npz beside it: min/max waveform peaks
+# at several zoom levels, the F0 contour autotune needs, per-frame RMS and
+# integrated loudness. Later steps read the sidecar instead of re-analysing.
+PEAK_LEVELS = (256, 1024, 4096, 16384)  # samples per peak bucket
+ANALYSIS_BLOCK = PEAK_LEVELS[-1] * 160  # ~1 min at 44.1 kHz; a multiple of AT_HOP too
+
+def k_weighting(sr):
+    """ITU-R BS.1770 K-weighting (shelf + high-pass) as second-order sections for any rate"""
+    def biquad(b, a):
+        return [*(np.array(b) / a[0]), 1.0, a[1] / a[0], a[2] / a[0]]
+    # High shelf, +4 dB above ~1.7 kHz
+    K, Q = np.tan(np.pi * 1681.974450955533 / sr), 0.7071752369554196
+    Vh = 10 ** (3.999843853973347 / 20)
+    Vb = Vh ** 0.4996667741545416
+    shelf = biquad([Vh + Vb * K / Q + K * K, 2 * (K * K - Vh), Vh - Vb * K / Q + K * K],
+                   [1 + K / Q + K * K, 2 * (K * K - 1), 1 - K / Q + K * K])
+    # High-pass at ~38 Hz
+    K, Q = np.tan(np.pi * 38.13547087602444 / sr), 0.5003270373238773
+    a0 = 1 + K / Q + K * K
+    highpass = [1.0, -2.0, 1.0, 1.0, 2 * (K * K - 1) / a0, (1 - K / Q + K * K) / a0]  # numerator as in the spec
+    return np.array([shelf, highpass])
+
+class LoudnessMeter:
+    """Integrated loudness in LUFS (BS.1770 gating), fed block by block"""
+    def __init__(self, sr, channels):
+        self.sos = k_weighting(sr)
+        self.zi = np.zeros((len(self.sos), 2, channels))
+        self.step = int(0.1 * sr)
+        self.rest = np.zeros(0)
+        self.steps = []  # mean square per 100 ms, summed over channels
+
+    def feed(self, block):
+        import scipy.signal
+        y, self.zi = scipy.signal.sosfilt(self.sos, block, axis=0, zi=self.zi)
+        energy = np.concatenate([self.rest, (y ** 2).sum(axis=1)])
+        n = len(energy) // self.step
+        self.steps.extend(energy[:n * self.step].reshape(n, self.step).mean(axis=1))
+        self.rest = energy[n * self.step:]
+
+    def integrated(self):
+        if len(self.steps) < 4:
             return None
-        
-        stems = split(str(p))
-        CURRENT_STEMS = stems
-        PROCESSING = False
-        return stems
-    except Exception as e:
-        PROCESSING = False
-        raise e
+        blocks = np.convolve(self.steps, np.ones(4) / 4, mode='valid')  # 400 ms, 75% overlap
+        lufs = lambda ms: -0.691 + 10 * np.log10(np.maximum(ms, 1e-12))
+        gated = blocks[lufs(blocks) > -70]
+        if not len(gated):
+            return None
+        gated = gated[lufs(gated) > lufs(gated.mean()) - 10]
+        return float(lufs(gated.mean()))
+
+def analysis_path(path):
+    path = pathlib.Path(path)
+    return path.with_name(path.name + ".analysis.npz")
+
+def _stamp(path):
+    st = os.stat(path)
+    return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+def load_analysis(path):
+    """The sidecar's arrays if it exists and matches the file as it is now, else None"""
+    side = analysis_path(path)
+    try:
+        with np.load(side) as data:
+            if np.array_equal(data['source'], _stamp(path)):
+                return dict(data)
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+def owns_path(path):
+    """Whether path is inside the app's own folders, where it may write sidecars next to files"""
+    path = pathlib.Path(path).resolve()
+    return any(path.is_relative_to(root.resolve()) for root in (DEST_DIR, STEM_DIR))
+
+def analyze_file(path):
+    """Compute (or reuse) path's sidecar in one streaming pass; returns its arrays"""
+    analysis = load_analysis(path)
+    cache_result('analysis', analysis is not None)
+    # Files elsewhere are analysed but never get a sidecar written beside them
+    return _analyze(path, persist=owns_path(path)) if analysis is None else analysis
+
+@timed('analysis')
+def _analyze(path, persist=True):
+    require('pitch')
+    count_bytes('in', path)
+    with tempfile.TemporaryDirectory() as work:
+        src = as_pcm_wav(path, work)
+        info = sf.info(str(src))
+        sr, channels = info.samplerate, info.channels
+        peaks = {spp: [] for spp in PEAK_LEVELS}
+        f0, rms = [], []
+        meter = LoudnessMeter(sr, channels)
+        for block in sf.blocks(str(src), blocksize=ANALYSIS_BLOCK, always_2d=True, dtype='float32'):
+            for spp in PEAK_LEVELS:
+                n = -(-len(block) // spp)
+                b = np.pad(block, ((0, n * spp - len(block)), (0, 0))).reshape(n, spp * channels)
+                peaks[spp].append(np.stack([b.min(axis=1), b.max(axis=1)], axis=1))
+            mono = block.mean(axis=1)
+            # Whole blocks keep len//hop frames so the contour lines up with one STFT over the file
+            keep = len(mono) // AT_HOP if len(block) == ANALYSIS_BLOCK else None
+            f0.append(detect_pitch(mono, sr)[:keep])
+            rms.append(librosa.feature.rms(y=mono, frame_length=AT_FRAME, hop_length=AT_HOP)[0][:keep])
+            meter.feed(block)
+    lufs = meter.integrated()
+    arrays = {
+        'source': _stamp(path), 'sr': np.int64(sr), 'frames': np.int64(info.frames), 'hop': np.int64(AT_HOP),
+        'f0': np.concatenate(f0).astype(np.float32), 'rms': np.concatenate(rms).astype(np.float32),
+        'lufs': np.float32(np.nan if lufs is None else lufs),
+        **{f"peaks_{spp}": np.clip(np.round(np.concatenate(p) * 127), -127, 127).astype(np.int8)
+           for spp, p in peaks.items()},
+    }
+    if persist:
+        side = analysis_path(path)
+        part = side.with_name(f".{uuid.uuid4().hex[:6]}.npz")
+        np.savez_compressed(part, **arrays)
+        os.replace(part, side)
+    return arrays
+
+def process_pitch_chunked(audio_file, output_path, amount=0, correction=False):
+    """process_pitch for long inputs: bounded memory via process_windows"""
+    with tempfile.TemporaryDirectory() as work:
+        src = as_pcm_wav(audio_file, work)
+        sr = sf.info(str(src)).samplerate
+        strength = min(max(amount, 0), 10) / 10.0
+
+        def fn(block):
+            y = block.mean(axis=1)  # mono, like librosa.load
+            y = autotune(y, sr, strength) if correction else librosa.effects.pitch_shift(y, sr=sr, n_steps=amount)
+            return {'out': y[:, None]}
+
+        with sf.SoundFile(output_path, 'w', sr, 1) as out:
+            process_windows(src, fn, {'out': out}, int(WINDOW_SECONDS * sr), int(XFADE_SECONDS * sr))
 
 # New function for pitch processing using sounddevice
 def process_pitch(audio_file, amount=0, correction=False):
-    """Process audio with pitch shifting or autotune using sounddevice"""
+    """Pitch-shift (amount in semitones) or autotune (amount is strength 0-10) audio_file; returns (path, error)"""
     try:
         # Check if required libraries are available
-        if 'sounddevice' not in sys.modules or 'soundfile' not in sys.modules or 'librosa' not in sys.modules:
-            return None, "Required modules (sounddevice, soundfile, librosa) not available"
-            
-        # Create a temporary file for the output
-        fd, output_path = tempfile.mkstemp(suffix='.wav')
-        os.close(fd)
-        
-        # Load the audio file
-        y, sr = librosa.load(audio_file, sr=None)
-        
-        if correction:  # Autotune
-            # More sophisticated autotune implementation
-            # First, detect the pitch
-            pitches, magnitudes = librosa.piptrack(y=y, sr=sr)
-            
-            # Get the most prominent pitch for each frame
-            pitch_frames = []
-            for i in range(pitches.shape[1]):
-                index = magnitudes[:, i].argmax()
-                pitch = pitches[index, i]
-                if pitch > 0:  # Filter out non-pitched frames
-                    pitch_frames.append(pitch)
-            
-            # Define musical notes (C major scale)
-            A4 = 440.0
-            C_MAJOR = [librosa.note_to_hz(n) for n in ['C4', 'D4', 'E4', 'F4', 'G4', 'A4', 'B4', 'C5']]
-            
-            # Apply correction differently based on amount parameter
-            # amount is treated as strength of correction (0-10)
-            strength = min(max(amount, 0), 10) / 10.0  # Normalize to 0-1 range
-            
-            # Process in short frames to apply the correction
-            frame_length = 2048
-            hop_length = 512
-            y_corrected = np.zeros_like(y)
-            
-            for i in range(0, len(y) - frame_length, hop_length):
-                frame = y[i:i+frame_length]
-                
-                # Get frame pitch
-                frame_pitches, frame_magnitudes = librosa.piptrack(y=frame, sr=sr)
-                if frame_pitches.size > 0:
-                    index = frame_magnitudes.argmax()
-                    pitch = frame_pitches.flatten()[index]
-                    
-                    if pitch > 0:
-                        # Find closest note in scale
-                        closest_note = min(C_MAJOR, key=lambda x: abs(x - pitch))
-                        
-                        # Apply correction with variable strength
-                        correction_amount = (closest_note - pitch) * strength
-                        semitones = 12 * np.log2(1 + correction_amount/pitch)
-                        
-                        # Apply pitch shift to this frame
-                        frame_corrected = librosa.effects.pitch_shift(frame, sr=sr, n_steps=semitones)
-                        
-                        # Add to output with crossfade
-                        if i > 0:  # Apply crossfade except for the first frame
-                            # Simple linear crossfade
-                            fade_len = min(hop_length, len(frame_corrected))
-                            fade_in = np.linspace(0, 1, fade_len)
-                            fade_out = np.linspace(1, 0, fade_len)
-                            
-                            # Apply crossfade
-                            y_corrected[i:i+fade_len] *= fade_out
-                            y_corrected[i:i+fade_len] += frame_corrected[:fade_len] * fade_in
-                            
-                            # Add the rest of the frame without crossfade
-                            if len(frame_corrected) > fade_len:
-                                y_corrected[i+fade_len:i+len(frame_corrected)] = frame_corrected[fade_len:]
-                        else:
-                            # First frame, no crossfade needed
-                            y_corrected[i:i+len(frame_corrected)] = frame_corrected
-                    else:
-                        # No pitch detected, use original frame
-                        y_corrected[i:i+len(frame)] = frame
-                else:
-                    # No pitch analysis available, use original frame
-                    y_corrected[i:i+len(frame)] = frame
-            
-            # Write the result
-            sf.write(output_path, y_corrected, sr)
-        else:  # Simple pitch shift
-            # Use librosa for pitch shifting
-            y_shifted = librosa.effects.pitch_shift(y, sr=sr, n_steps=amount)
-            sf.write(output_path, y_shifted, sr)
-            
-        return output_path, None
+        if not capability('pitch')['available']:
+            return None, "Required modules (soundfile, librosa) not available"
+        require('pitch')
+        if correction:
+            amount = min(max(amount, 0), 10)
+        return PITCH_CACHE.fetch(audio_file, amount, correction), None
     except Exception as e:
         return None, str(e)
 
+# === Pitch cache ===
+# Slider drags send the same file with many amounts, often repeating one. The
+# rendered WAVs are kept in a temp directory keyed on (content, mode, amount)
+# and expire after L2W_PITCH_TTL seconds or when the directory outgrows its
+# budget; the decoded input and its pitch track stay in memory (LRU, bounded)
+# so a new amount only pays for the resynthesis.
+PITCH_DIR = pathlib.Path(tempfile.gettempdir()) / "link2wave-pitch"
+PITCH_CACHE_BYTES = int(float(os.environ.get('L2W_PITCH_CACHE_MB', 1000)) * 2**20)
+PITCH_MEMORY_BYTES = int(float(os.environ.get('L2W_PITCH_MEMORY_MB', 512)) * 2**20)
+PITCH_TTL = float(os.environ.get('L2W_PITCH_TTL', 3600))
+
+class PitchCache:
+    """Rendered outputs on disk keyed on (input, mode, amount), plus decoded inputs (not results) in memory"""
+    def __init__(self, root, budget=PITCH_CACHE_BYTES, memory=PITCH_MEMORY_BYTES, ttl=PITCH_TTL):
+        self.root, self.budget, self.memory, self.ttl = pathlib.Path(root), budget, memory, ttl
+        self.inputs = {}  # digest -> {'y', 'sr', 'f0'}, oldest first
+        self.pending = {}  # key -> Future of the render in progress
+        self.lock = threading.Lock()
+        self.swept = 0.0
+        self.sweeper = None
+
+    def _start_sweeper(self):
+        # Expire outputs on a timer too, so they don't outlive the TTL while no one asks for one
+        with self.lock:
+            if not self.sweeper:
+                self.sweeper = every(min(60, max(self.ttl, 1)), lambda: self.sweep(force=True), "pitch-sweep")
+
+    def fetch(self, audio_file, amount, correction):
+        """Path of the rendered output, rendering it only if no live copy exists"""
+        self._start_sweeper()
+        digest = file_etag(audio_file)
+        key = f"{digest}-{'autotune' if correction else 'shift'}-{round(float(amount), 2):g}"
+        dst = self.root / f"{key}.wav"
+        with self.lock:
+            fut = self.pending.get(key)
+            owner = fut is None and not dst.exists()
+            if owner:
+                fut = self.pending[key] = Future()
+        cache_result('pitch', not owner)
+        if fut is None:
+            os.utime(dst)  # a hit counts as a fresh access for expiry
+            self.sweep()
+            return str(dst)
+        if not owner:
+            return fut.result()
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            part = self.root / f".{uuid.uuid4().hex[:6]}.wav"
+            try:
+                self.render(audio_file, digest, part, amount, correction)
+                os.replace(part, dst)
+            finally:
+                part.unlink(missing_ok=True)
+            fut.set_result(str(dst))
+        except Exception as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+        self.sweep(force=True, keep=dst)
+        return str(dst)
+
+    @timed('pitch')
+    def render(self, audio_file, digest, output_path, amount, correction):
+        count_bytes('in', audio_file)
+        self._render(audio_file, digest, output_path, amount, correction)
+        count_bytes('out', output_path)
+
+    def _render(self, audio_file, digest, output_path, amount, correction):
+        # Long files are processed window by window instead of loaded whole
+        if audio_seconds(audio_file) > CHUNK_SECONDS:
+            return process_pitch_chunked(audio_file, output_path, amount, correction)
+        entry = self.decoded(audio_file, digest)
+        y, sr = entry['y'], entry['sr']
+        if correction:  # Autotune
+            if entry['f0'] is None:
+                # Reuse the stored pitch track when this file has been analysed
+                analysis = load_analysis(audio_file)
+                f0 = analysis['f0'] if analysis is not None and int(analysis['sr']) == sr else detect_pitch(y, sr)
+                self.remember(digest, dict(entry, f0=f0))
+                entry['f0'] = f0
+            out = autotune(y, sr, amount / 10.0, entry['f0'])
+        else:  # Simple pitch shift
+            out = librosa.effects.pitch_shift(y, sr=sr, n_steps=amount)
+        sf.write(output_path, out, sr)
+
+    def decoded(self, audio_file, digest):
+        """The decoded mono input from memory, loading it on a miss"""
+        with self.lock:
+            entry = self.inputs.pop(digest, None)
+            cache_result('pitch_input', entry is not None)
+            if entry is not None:
+                self.inputs[digest] = entry  # most recent last
+                return dict(entry)
+        y, sr = librosa.load(audio_file, sr=None)
+        entry = {'y': y, 'sr': sr, 'f0': None}
+        self.remember(digest, entry)
+        return dict(entry)
+
+    def remember(self, digest, entry):
+        nbytes = lambda e: e['y'].nbytes + (0 if e['f0'] is None else e['f0'].nbytes)
+        with self.lock:
+            self.inputs.pop(digest, None)
+            if nbytes(entry) > self.memory:
+                return
+            self.inputs[digest] = entry
+            total = sum(nbytes(e) for e in self.inputs.values())
+            for old in list(self.inputs):
+                if total <= self.memory:
+                    break
+                total -= nbytes(self.inputs.pop(old))
+
+    def sweep(self, force=False, keep=None):
+        """Delete outputs older than the TTL, then least-recently-used ones until under budget"""
+        now = time.time()
+        if not force and now - self.swept < 60:
+            return
+        self.swept = now
+        expire_files(self.root, "*.wav", self.ttl, self.budget, keep)
+
+PITCH_CACHE = PitchCache(PITCH_DIR)
+
+# === Live pitch ===
+# The vocal booth streams mic blocks over the /live WebSocket. LivePitch is
+# shift_curve made incremental: it keeps the last frame's phases and the
+# overlap-add tail between blocks and returns as many samples as it is given,
+# delayed by one FFT frame. Pitch for autotune comes from the frame's own
+# spectrum (piptrack's peak pick), so no look-ahead is needed.
+LIVE_FFT, LIVE_HOP = 1024, 256  # ~23 ms of latency at 44.1 kHz
+LIVE_MAX_BLOCK = 1 << 15
+
+def frame_pitch(frames, mag, sr, fmin=150.0, fmax=4000.0, floor=1e-3):
+    """Per-frame pitch in Hz from the strongest spectral peak between fmin and fmax (0 where quiet)"""
+    n_fft = frames.shape[1]
+    lo, hi = max(int(fmin * n_fft / sr), 1), min(int(fmax * n_fft / sr), mag.shape[1] - 2)
+    band = mag[:, lo:hi + 1]
+    k = band.argmax(axis=1) + lo
+    rows = np.arange(len(k))
+    left, mid, right = mag[rows, k - 1], mag[rows, k], mag[rows, k + 1]
+    # Parabolic interpolation, as in librosa.piptrack
+    denom = 2 * mid - left - right
+    shift = np.divide(0.5 * (right - left), denom, out=np.zeros_like(mid), where=denom > 0)
+    f0 = (k + shift) * sr / n_fft
+    return np.where(np.sqrt((frames ** 2).mean(axis=1)) > floor, f0, 0.0)
+
+class LivePitch:
+    """Incremental pitch shift ('shift', amount in semitones) or autotune ('autotune', strength 0-10)"""
+    def __init__(self, sr, mode='shift', amount=0.0, n_fft=LIVE_FFT, hop=LIVE_HOP):
+        if isinstance(sr, bool) or not isinstance(sr, (int, float)) or not float(sr).is_integer() or sr <= 0:
+            raise ValueError('sr must be a positive integer sample rate')
+        self.sr, self.n_fft, self.hop = int(sr), n_fft, hop
+        self.window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(n_fft) / n_fft)  # periodic Hann, as librosa
+        self.norm = (self.window ** 2).sum() / hop  # squared-window overlap for OLA
+        self.omega = 2 * np.pi * hop * np.arange(n_fft // 2 + 1) / n_fft
+        self.history = np.zeros(n_fft - hop)
+        self.tail = np.zeros(n_fft - hop)
+        self.prev_phase = np.zeros(n_fft // 2 + 1)
+        self.out_phase = np.zeros(n_fft // 2 + 1)
+        self.ready = np.zeros(hop)  # processed samples not yet returned
+        self.configure(mode, amount)
+
+    @property
+    def latency(self):
+        return self.n_fft / self.sr
+
+    def configure(self, mode, amount):
+        if mode not in ('shift', 'autotune'):
+            raise ValueError(f'Unknown mode {mode}')
+        if isinstance(amount, bool) or not isinstance(amount, (int, float)) or not np.isfinite(amount):
+            raise ValueError('amount must be a number')
+        self.mode, self.amount = mode, float(amount)
+
+    def process(self, block):
+        """Processed audio for block (mono float32), the same length, one frame behind"""
+        buf = np.concatenate([self.history, block])
+        n = (len(buf) - self.n_fft) // self.hop + 1 if len(buf) >= self.n_fft else 0
+        out = []
+        if n:
+            frames = np.lib.stride_tricks.sliding_window_view(buf, self.n_fft)[::self.hop][:n]
+            out = [self._frames(frames)]
+        self.history = buf[n * self.hop:]
+        ready = np.concatenate([self.ready, *out])
+        self.ready = ready[len(block):]
+        return ready[:len(block)].astype(np.float32)
+
+    def _frames(self, frames):
+        S = np.fft.rfft(frames * self.window, axis=1)
+        mag, phase = np.abs(S), np.angle(S)
+        if self.mode == 'autotune':
+            semitones = snap_to_scale(frame_pitch(frames, mag, self.sr)) * min(max(self.amount, 0), 10) / 10
+        else:
+            semitones = np.full(len(frames), self.amount)
+        ratio = 2.0 ** (semitones / 12.0)
+
+        # Same bin remapping as shift_curve, with frames along axis 0
+        dphi = np.diff(phase, axis=0, prepend=self.prev_phase[None, :]) - self.omega
+        dphi -= 2 * np.pi * np.round(dphi / (2 * np.pi))
+        advance = self.omega + dphi
+        self.prev_phase = phase[-1]
+        n_frames, n_bins = S.shape
+        target = np.rint(np.arange(n_bins)[None, :] * ratio[:, None]).astype(np.int64)
+        rows = np.broadcast_to(np.arange(n_frames)[:, None], target.shape)
+        keep = target < n_bins
+        flat = rows[keep] * n_bins + target[keep]
+        out_mag = np.bincount(flat, weights=mag[keep], minlength=S.size).reshape(S.shape)
+        out_adv = np.zeros(S.shape)
+        out_adv.flat[flat] = (advance * ratio[:, None])[keep]
+        out_phase = self.out_phase + np.cumsum(out_adv, axis=0)
+        self.out_phase = np.mod(out_phase[-1], 2 * np.pi)
+
+        y = np.fft.irfft(out_mag * np.exp(1j * out_phase), n=self.n_fft, axis=1) * self.window / self.norm
+        acc = np.zeros((n_frames - 1) * self.hop + self.n_fft)
+        acc[:len(self.tail)] += self.tail
+        for i, frame in enumerate(y):
+            acc[i * self.hop:i * self.hop + self.n_fft] += frame
+        self.tail = acc[n_frames * self.hop:]
+        return acc[:n_frames * self.hop]
+
 def convert_audio(webm_file, fmt='wav'):
-    """Convert webm to wav or mp3"""
+    """Convert a take to any transcode preset (wav, mp3, flac, opus...)"""
     try:
         # Create output filename
         output_dir = DEST_DIR / "recordings"
         output_dir.mkdir(parents=True, exist_ok=True)
         
+        # One file per take and preset, so wav and wav-48k never share a name
         timestamp = hashlib.md5(str(webm_file).encode()).hexdigest()[:8]
-        output_path = output_dir / f"take_{timestamp}.{fmt}"
+        output_path = export_path(pathlib.Path(f"take_{timestamp}"), fmt, output_dir)
         
-        # Set options based on format
-        opts = "-ac 2 -ar 44100" if fmt=="wav" else "-b:a 192k"
-        
-        # Run FFmpeg conversion
-        run(f'ffmpeg {FFMPEG_OPTS} -y -i "{webm_file}" {opts} "{output_path}"', quiet=True)
+        # Reuses an existing conversion unless the take has changed since
+        transcode(webm_file, output_path, fmt)
         
         return str(output_path), None
     except Exception as e:
         return None, str(e)
 
+# === Audio serving ===
+# Byte ranges and If-None-Match are handled by send_file(conditional=True); we
+# supply strong content ETags and mark content-addressed URLs immutable.
+PREVIEW_DIR = DEST_DIR / "previews"
+PREVIEW_TTL = float(os.environ.get('L2W_PREVIEW_TTL', 7 * 86400))
+PREVIEW_CACHE_BYTES = int(float(os.environ.get('L2W_PREVIEW_CACHE_MB', 1000)) * 2**20)
+PREVIEW_PRESETS = {
+    'opus': ('ogg', '-c:a libopus -b:a 96k'),
+    'mp3': ('mp3', '-c:a libmp3lame -b:a 128k'),
+}
+_etags = {}
+_etags_lock = threading.Lock()
+
+def file_etag(path):
+    """Strong ETag from the file's bytes, memoized on (path, mtime, size)"""
+    st = os.stat(path)
+    memo = (str(path), st.st_mtime_ns, st.st_size)
+    with _etags_lock:
+        if memo in _etags:
+            return _etags[memo]
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    with _etags_lock:
+        _etags[memo] = h.hexdigest()
+    return _etags[memo]
+
+def preview_file(path, kind):
+    """Small Opus/MP3 copy of path for auditioning, cached by the source's ETag"""
+    ext, opts = PREVIEW_PRESETS[kind]
+    PREVIEW_DIR.mkdir(parents=True, exist_ok=True)
+    dst = PREVIEW_DIR / f"{file_etag(path)}.{ext}"
+    cache_result('preview', dst.exists())
+    if dst.exists():
+        os.utime(dst)  # a hit counts as a fresh access for expiry
+        return dst
+    require('preview')
+    part = dst.with_name(f".{uuid.uuid4().hex[:6]}.{ext}")
+    try:
+        run(f'ffmpeg {FFMPEG_OPTS} -y -i "{path}" -vn {opts} "{part}"', quiet=True)
+        os.replace(part, dst)
+    finally:
+        part.unlink(missing_ok=True)
+    expire_files(PREVIEW_DIR, "*.*", PREVIEW_TTL, PREVIEW_CACHE_BYTES, keep=dst)
+    return dst
+
+def sweep_previews():
+    expire_files(PREVIEW_DIR, "*.*", PREVIEW_TTL, PREVIEW_CACHE_BYTES)
+
+# Browser previews of a window of a file, decoded by seeking rather than reading
+# from the start. 'wav' needs only soundfile; the compressed kinds pipe through ffmpeg.
+PREVIEW_MAX_SECONDS = float(os.environ.get('L2W_PREVIEW_MAX_SECONDS', 30))
+PREVIEW_MIMETYPES = {'ogg': 'audio/ogg', 'mp3': 'audio/mpeg', 'wav': 'audio/wav'}
+
+def read_window(path, start, duration):
+    """(frames, samplerate) for [start, start + duration) seconds, or None if soundfile can't seek in path"""
+    try:
+        with sf.SoundFile(str(path)) as f:
+            f.seek(min(int(start * f.samplerate), f.frames))
+            return f.read(int(duration * f.samplerate), dtype='float32', always_2d=True), f.samplerate
+    except RuntimeError:
+        return None
+
+def preview_window(path, start, duration, kind='opus'):
+    """(chunks, mimetype): the window encoded as kind, produced as it is encoded"""
+    window = read_window(path, start, duration)
+    if kind == 'wav' and window is not None:
+        buf = io.BytesIO()
+        sf.write(buf, window[0], window[1], format='WAV', subtype='PCM_16')
+        return iter([buf.getvalue()]), PREVIEW_MIMETYPES['wav']
+    require('preview')  # everything past here goes through ffmpeg
+    ext, opts = PREVIEW_PRESETS.get(kind, ('wav', '-c:a pcm_s16le'))
+    if window is None:  # let ffmpeg seek in the container instead
+        src = ['-ss', str(start), '-t', str(duration), '-i', str(path)]
+    else:
+        src = ['-f', 'f32le', '-ar', str(window[1]), '-ac', str(window[0].shape[1]), '-i', 'pipe:0']
+    cmd = ['ffmpeg', *shlex.split(FFMPEG_OPTS), *src, '-vn', *shlex.split(opts), '-f', ext, 'pipe:1']
+    return encode_stream(cmd, None if window is None else [window[0].tobytes()]), PREVIEW_MIMETYPES[ext]
+
+def encode_stream(cmd, feed=None):
+    """Yield what an ffmpeg cmd writes to pipe:1 as it writes it; feed (iterable of bytes) goes to its stdin"""
+    p = subprocess.Popen(cmd, stdin=subprocess.DEVNULL if feed is None else subprocess.PIPE,
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if feed is not None:
+        def pump():
+            try:
+                for data in feed:
+                    p.stdin.write(data)
+                p.stdin.close()
+            except OSError:
+                pass  # the client went away and the encoder was killed
+        threading.Thread(target=pump, daemon=True).start()
+
+    def chunks():
+        try:
+            for chunk in iter(lambda: p.stdout.read1(1 << 16), b''):
+                yield chunk
+        finally:
+            p.kill()
+            p.wait()
+    return chunks()
+
+# Stem bundles are built while they are sent: a stored (uncompressed, WAV
+# barely compresses) zip written through a sink that is drained after every
+# chunk, or the stems interleaved into one multichannel FLAC by ffmpeg.
+BUNDLE_MIMETYPES = {'zip': 'application/zip', 'flac': 'audio/flac'}
+
+class _Sink:
+    """Unseekable write-only file; zipfile then streams with data descriptors"""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        out, self.chunks = b''.join(self.chunks), []
+        return out
+
+def zip_stream(files):
+    """Yield a zip of {arcname: path} as it is written; nothing is staged on disk"""
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for arcname, path in files.items():
+            with open(path, 'rb') as src, zf.open(zipfile.ZipInfo.from_file(path, arcname), 'w', force_zip64=True) as dst:
+                for chunk in iter(lambda: src.read(1 << 20), b''):
+                    dst.write(chunk)
+                    yield sink.drain()
+    yield sink.drain()
+
+def flac_stream(paths):
+    """Yield one FLAC holding every file's channels side by side (stem order), encoded as it is sent"""
+    infos = [sf.info(str(p)) for p in paths]
+    sr, channels = infos[0].samplerate, sum(i.channels for i in infos)
+    if any(i.samplerate != sr for i in infos):
+        raise ValueError('Stems have different sample rates')
+    if channels > 8:
+        raise ValueError(f'FLAC holds at most 8 channels, these stems have {channels}; use the zip bundle')
+
+    def interleaved():
+        files = [sf.SoundFile(str(p)) for p in paths]
+        try:
+            while True:
+                blocks = [f.read(1 << 16, dtype='float32', always_2d=True) for f in files]
+                n = max(len(b) for b in blocks)
+                if not n:
+                    return
+                yield np.hstack([np.pad(b, ((0, n - len(b)), (0, 0))) for b in blocks]).tobytes()
+        finally:
+            for f in files:
+                f.close()
+    cmd = ['ffmpeg', *shlex.split(FFMPEG_OPTS), '-f', 'f32le', '-ar', str(sr), '-ac', str(channels), '-i', 'pipe:0',
+           '-c:a', 'flac', '-f', 'flac', 'pipe:1']
+    return encode_stream(cmd, interleaved())
+
+def serve_audio(path, as_attachment=False, immutable=False):
+    """send_file with range support, content ETags and ?preview=opus|mp3"""
+    # immutable only when the URL itself names the content (a separation id);
+    # paths like /play/<stem> follow CURRENT_STEMS and must be revalidated
+    path = src = pathlib.Path(path)
+    kind = request.args.get('preview')
+    if kind in PREVIEW_PRESETS:
+        try:
+            path = preview_file(src, kind)
+        except RuntimeError as e:  # no ffmpeg here, or it could not decode the file
+            return jsonify({'status': 'error', 'error': str(e)}), 500
+    resp = send_file(path, as_attachment=as_attachment, download_name=f"{src.stem}{path.suffix}",
+                     conditional=True, etag=file_etag(path), max_age=31536000 if immutable else None)
+    if immutable:
+        resp.cache_control.immutable = True
+    METRICS.inc('l2w_bytes_total', resp.content_length or 0, stage='serve', direction='out')
+    return resp  # otherwise send_file marks it no-cache, i.e. revalidate via ETag
+
 # Routes
 @app.route('/')
 def index():
@@ -209,20 +2231,20 @@ def index():
                            last_rip=LAST_RIP, 
                            stems=CURRENT_STEMS)
 
+BUSY_MSG = 'The server is busy, please try again shortly.'
+
 @app.route('/rip', methods=['POST'])
 def rip():
-    if PROCESSING:
-        flash('Another operation is in progress. Please wait.', 'error')
-        return redirect(url_for('index'))
-    
     # Check if form or JSON data
     if request.is_json:
         data = request.get_json()
         url = data.get('url')
         fmt = data.get('format', 'mp3')
+        stream = data.get('stream', STREAM_RIPS)
     else:
         url = request.form.get('url')
         fmt = request.form.get('format', 'mp3')
+        stream = request.form.get('stream', '1' if STREAM_RIPS else '0') != '0'
     
     if not url or not url.startswith('http'):
         if request.is_json:
@@ -230,70 +2252,200 @@ def rip():
         flash('Please enter a valid YouTube URL', 'error')
         return redirect(url_for('index'))
     
-    # Start processing in a separate thread
-    def process_rip():
-        try:
-            result = rip_audio(url, fmt)
-            app.config['SHOULD_RELOAD'] = True
-            # If request expects JSON, prepare response data
-            if request.is_json:
-                app.config['JSON_RESULT'] = {
-                    'status': 'ok',
-                    'filename': os.path.basename(result),
-                    'filepath': result
-                }
-        except Exception as e:
-            app.config['SHOULD_RELOAD'] = True
-            if request.is_json:
-                app.config['JSON_RESULT'] = {'status': 'error', 'error': str(e)}
-            else:
-                flash(f'Error: {str(e)}', 'error')
-    
-    threading.Thread(target=process_rip).start()
+    try:
+        job_id = submit_job('rip-stream' if stream else 'rip', url=url, format=fmt)
+    except queue.Full:
+        if request.is_json:
+            return jsonify({'status': 'error', 'error': BUSY_MSG}), 503
+        flash(BUSY_MSG, 'error')
+        return redirect(url_for('index'))
     app.config['ACTIVE_TAB'] = 'rip'
     
     # Handle JSON requests differently
     if request.is_json:
-        return jsonify({'status': 'processing'})
+        return jsonify({'status': 'processing', 'job_id': job_id})
     
     return redirect(url_for('index'))
 
-@app.route('/check-rip-status')
-def check_rip_status():
-    """Check the status of an async rip operation"""
-    if not PROCESSING and 'JSON_RESULT' in app.config:
-        result = app.config.pop('JSON_RESULT')
-        return jsonify(result)
-    return jsonify({'status': 'processing'})
+@app.route('/rip/batch', methods=['POST'])
+def rip_batch():
+    """Rip a list of URLs and/or playlists; each video becomes a child job of one batch job"""
+    data = request.get_json(silent=True) or {}
+    urls = data.get('urls') or ([data['url']] if data.get('url') else [])
+    if not urls or not all(isinstance(u, str) and u.startswith('http') for u in urls):
+        return jsonify({'status': 'error', 'error': 'Please provide a list of valid URLs'}), 400
+    
+    try:
+        job_id = submit_job('batch', urls=urls, format=data.get('format', 'mp3'),
+                            stream=data.get('stream', STREAM_RIPS))
+    except queue.Full:
+        return jsonify({'status': 'error', 'error': BUSY_MSG}), 503
+    return jsonify({'status': 'processing', 'job_id': job_id})
+
+@app.route('/transcode', methods=['POST'])
+def transcode_batch():
+    """Encode many files, or a separation's stems, into one or more presets as a batch of jobs"""
+    data = request.get_json(silent=True) or {}
+    presets = data.get('presets') or [data.get('preset', 'wav')]
+    unknown = [p for p in presets if p not in TRANSCODE_PRESETS]
+    if unknown:
+        return jsonify({'status': 'error', 'error': f"Unknown preset(s) {', '.join(unknown)}; "
+                                                    f"choose from {', '.join(TRANSCODE_PRESETS)}"}), 400
+    dest = None  # files: a folder per source folder (export_dir)
+    files = data.get('files') or []
+    if data.get('separation'):
+        found, err = _find_stems(data['separation'])
+        if err:
+            return err
+        files = [str(path) for path in found[1].values()]
+        dest = str(DEST_DIR / "exports" / f"{found[0]}-{data['separation']}")
+    if not files or not all(isinstance(f, str) and os.path.isfile(f) for f in files):
+        return jsonify({'status': 'error', 'error': 'Please provide existing files or a separation id'}), 400
+    
+    try:
+        job_id = submit_job('export', files=files, presets=presets, dest=dest)
+    except queue.Full:
+        return jsonify({'status': 'error', 'error': BUSY_MSG}), 503
+    return jsonify({'status': 'processing', 'job_id': job_id})
+
+@app.route('/library')
+def library():
+    """Ripped files, newest first; ?q= searches title and uploader, ?format= filters by preset"""
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    rows, total = LIBRARY.list(request.args.get('q'), request.args.get('format'), limit, offset)
+    items = [{'id': r['video_id'], 'extractor': r['extractor'], 'format': r['format'], 'title': r['title'],
+              'uploader': r['uploader'], 'duration': r['duration'], 'url': r['url'],
+              'filename': os.path.basename(r['path']), 'filepath': r['path'], 'size': r['size'],
+              'created': r['created']} for r in rows]
+    return jsonify({'status': 'ok', 'total': total, 'items': items})
+
+@app.route('/jobs')
+def list_jobs():
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify({'status': 'ok', 'jobs': [public_job(j) for j in JOBS.list(limit)]})
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = JOBS.get(job_id)
+    if not job:
+        return jsonify({'status': 'error', 'error': 'Job not found'}), 404
+    return jsonify(public_job(job))
+
+def sse(event):
+    return f"data: {json.dumps(event)}\n\n"
+
+EVENT_POLL = 2  # seconds between job-record checks on an idle per-job stream
+
+def event_stream(key):
+    """text/event-stream of EVENTS for one job ID or '*'; idle connections get keepalives"""
+    q = EVENTS.subscribe(key)  # before the snapshot, so nothing falls in between
+    job = JOBS.get(key) if key != '*' else None
+    finished = lambda ev: key != '*' and ev.get('type') == 'status' and ev['status'] in ('done', 'error')
+
+    def gen():
+        # EVENTS only carries what this process runs; a job on another worker is
+        # followed by polling its record, so its status changes still arrive
+        last, idle = job and job['updated'], 0.0
+        try:
+            if job:
+                first = {'type': 'status', 'job': key, **public_job(job)}
+                yield sse(first)
+                if finished(first):
+                    return
+            while True:
+                try:
+                    ev = q.get(timeout=EVENT_POLL)
+                except queue.Empty:
+                    current = JOBS.get(key) if key != '*' else None
+                    if current and current['updated'] != last:
+                        ev = {'type': 'status', 'job': key, **public_job(current)}
+                    else:
+                        idle += EVENT_POLL
+                        if idle >= 15:
+                            idle = 0.0
+                            yield ": keepalive\n\n"
+                        continue
+                if ev.get('type') == 'status':
+                    last = ev.get('updated', last)
+                yield sse(ev)
+                if finished(ev):
+                    return
+        finally:
+            EVENTS.unsubscribe(key, q)
+
+    return Response(gen(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/jobs/<job_id>/trace')
+def job_trace(job_id):
+    """Timeline of a job: each stage, the pipeline steps inside it and every external command"""
+    job = JOBS.get(job_id)
+    if not job:
+        return jsonify({'status': 'error', 'error': 'Job not found'}), 404
+    return jsonify({'status': 'ok', 'job': public_job(job), 'trace': JOBS.trace(job_id)})
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus text exposition of stage timings, queues, caches and bytes"""
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    if not JOBS.get(job_id):
+        return jsonify({'status': 'error', 'error': 'Job not found'}), 404
+    return event_stream(job_id)
+
+@app.route('/events')
+def all_events():
+    return event_stream('*')
+
+def upload_error(e):
+    return jsonify({'status': 'error', 'error': str(e), **e.extra}), e.code
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """Open a resumable upload: {"filename", "size", "sha256" (optional, lets a known file skip the upload)}"""
+    data = request.get_json(silent=True) or {}
+    try:
+        return jsonify(UPLOADS.create(data.get('filename'), data.get('size'), data.get('sha256')))
+    except UploadError as e:
+        return upload_error(e)
+
+@app.route('/uploads/<upload_id>', methods=['GET', 'PUT', 'DELETE'])
+def upload_session(upload_id):
+    """GET the offset to resume from, PUT the next chunk at ?offset=, DELETE to abandon"""
+    try:
+        if request.method == 'GET':
+            return jsonify(UPLOADS.status(upload_id))
+        if request.method == 'DELETE':
+            UPLOADS.abort(upload_id)
+            return jsonify({'status': 'ok'})
+        offset = request.args.get('offset', type=int)
+        if offset is None:
+            return jsonify({'status': 'error', 'error': 'offset is required'}), 400
+        return jsonify(UPLOADS.write(upload_id, offset, request.stream, request.content_length))
+    except UploadError as e:
+        return upload_error(e)
+
+def uploaded_file(digest):
+    path = UPLOADS.find(str(digest or '').lower())
+    return str(path) if path else None
 
 @app.route('/separate', methods=['POST'])
 def separate():
-    if PROCESSING:
-        if request.is_json:
-            return jsonify({'status': 'error', 'error': 'Another operation is in progress'})
-        flash('Another operation is in progress. Please wait.', 'error')
-        return redirect(url_for('index'))
-    
-    # Handle JSON requests for path-based separation
+    # Handle JSON requests for path-based separation, or of a finished upload
     if request.is_json:
-        filepath = request.json.get('filepath')
+        digest = request.json.get('upload')
+        filepath = uploaded_file(digest) if digest else request.json.get('filepath')
         if not filepath or not os.path.exists(filepath):
             return jsonify({'status': 'error', 'error': 'File not found'})
         
-        # Start processing in a separate thread for API
-        def process_api_separation():
-            try:
-                results = separate_audio(filepath)
-                if results:
-                    stem_data = [{'name': name, 'path': str(path)} for name, path in results.items()]
-                    app.config['JSON_RESULT'] = {'status': 'ok', 'stems': stem_data}
-                else:
-                    app.config['JSON_RESULT'] = {'status': 'error', 'error': 'Separation failed'}
-            except Exception as e:
-                app.config['JSON_RESULT'] = {'status': 'error', 'error': str(e)}
-        
-        threading.Thread(target=process_api_separation).start()
-        return jsonify({'status': 'processing'})
+        try:
+            job_id = submit_job('separate', filepath=filepath, digest=digest and digest.lower())
+        except queue.Full:
+            return jsonify({'status': 'error', 'error': BUSY_MSG}), 503
+        return jsonify({'status': 'processing', 'job_id': job_id})
     
     # Handle form-based file upload
     if 'audioFile' not in request.files:
@@ -307,45 +2459,23 @@ def separate():
         flash('No file selected', 'error')
         return redirect(url_for('index'))
     
-    # Save the uploaded file
-    temp_dir = tempfile.mkdtemp()
-    file_path = os.path.join(temp_dir, file.filename)
-    file.save(file_path)
-    
-    # Start processing in a separate thread
-    def process_separation():
-        try:
-            results = separate_audio(file_path)
-            app.config['SHOULD_RELOAD'] = True
-        except Exception as e:
-            app.config['SHOULD_RELOAD'] = True
-            flash(f'Error during separation: {str(e)}', 'error')
-    
-    threading.Thread(target=process_separation).start()
-    app.config['ACTIVE_TAB'] = 'separate'
-    
-    return redirect(url_for('index'))
+    # Stream it into the upload store, hashed on the way in
+    upload = UPLOADS.ingest(file.stream, file.filename)
+    return _queue_separation(upload['filepath'], upload['digest'])
 
 @app.route('/separate-last')
 def separate_last():
-    if PROCESSING:
-        flash('Another operation is in progress. Please wait.', 'error')
-        return redirect(url_for('index'))
-    
     if not LAST_RIP:
         flash('No audio has been ripped yet', 'error')
         return redirect(url_for('index'))
     
-    # Start processing in a separate thread
-    def process_separation():
-        try:
-            results = separate_audio(LAST_RIP)
-            app.config['SHOULD_RELOAD'] = True
-        except Exception as e:
-            app.config['SHOULD_RELOAD'] = True
-            flash(f'Error during separation: {str(e)}', 'error')
-    
-    threading.Thread(target=process_separation).start()
+    return _queue_separation(LAST_RIP)
+
+def _queue_separation(file_path, digest=None):
+    try:
+        submit_job('separate', filepath=file_path, digest=digest)
+    except queue.Full:
+        flash(BUSY_MSG, 'error')
     app.config['ACTIVE_TAB'] = 'separate'
     
     return redirect(url_for('index'))
@@ -357,7 +2487,7 @@ def download_file():
         flash('File not found', 'error')
         return redirect(url_for('index'))
     
-    return send_file(file_path, as_attachment=True)
+    return serve_audio(file_path, as_attachment=True)
 
 @app.route('/download/<stem_name>')
 def download_stem(stem_name):
@@ -366,7 +2496,7 @@ def download_stem(stem_name):
         return redirect(url_for('index'))
     
     stem_path = CURRENT_STEMS[stem_name]
-    return send_file(str(stem_path), as_attachment=True)
+    return serve_audio(stem_path, as_attachment=True)
 
 @app.route('/play/<stem_name>')
 def play_stem(stem_name):
@@ -377,37 +2507,164 @@ def play_stem(stem_name):
     stem_path = CURRENT_STEMS[stem_name]
     
     # For web playback, better to send the file
-    return send_file(str(stem_path))
+    return serve_audio(stem_path)
+
+def separation_stems(job_id):
+    """(song name, {stem: path}) for a finished separation job, or None if there is no such job"""
+    job = JOBS.get(job_id)
+    if not job or job['kind'] != 'separate' or job['status'] != 'done':
+        return None
+    return (pathlib.Path(job['params']['filepath']).stem,
+            {stem['name']: pathlib.Path(stem['path']) for stem in job['result']['stems']})
+
+def _find_stems(job_id):
+    """separation_stems, or the error response to return instead"""
+    found = separation_stems(job_id)
+    if found is None:
+        return None, (jsonify({'status': 'error', 'error': 'No finished separation with that id'}), 404)
+    if not all(p.exists() for p in found[1].values()):
+        return None, (jsonify({'status': 'error', 'error': 'These stems were evicted from the cache; separate again'}), 410)
+    return found, None
+
+@app.route('/separations/<job_id>/stems/<stem_name>')
+def separation_stem(job_id, stem_name):
+    """One stem of any finished separation (?download=1 for an attachment)"""
+    found, err = _find_stems(job_id)
+    if err:
+        return err
+    if stem_name not in found[1]:
+        return jsonify({'status': 'error', 'error': 'Stem not found'}), 404
+    return serve_audio(found[1][stem_name], as_attachment=bool(request.args.get('download')), immutable=True)
+
+@app.route('/separations/<job_id>/bundle.<fmt>')
+def separation_bundle(job_id, fmt):
+    """Every stem in one download: a zip of the WAVs or a multichannel FLAC, streamed as it is built"""
+    if fmt not in BUNDLE_MIMETYPES:
+        return jsonify({'status': 'error', 'error': 'Bundles are zip or flac'}), 404
+    found, err = _find_stems(job_id)
+    if err:
+        return err
+    song, stems = found
+    if fmt == 'zip':
+        body = zip_stream({f"{song}/{path.name}": path for path in stems.values()})
+        headers = {}
+    else:
+        try:
+            require('preview')
+            body = flac_stream(list(stems.values()))
+        except (RuntimeError, ValueError) as e:
+            return jsonify({'status': 'error', 'error': str(e)}), 400
+        # Which channels hold which stem, e.g. vocals=1-2,drums=3-4
+        spans, first = [], 1
+        for name, path in stems.items():
+            n = sf.info(str(path)).channels
+            spans.append(f"{name}={first}-{first + n - 1}")
+            first += n
+        headers = {'X-Stem-Channels': ','.join(spans)}
+    resp = Response(body, mimetype=BUNDLE_MIMETYPES[fmt], headers=headers)
+    resp.headers.set('Content-Disposition', 'attachment', filename=f"{song}-stems.{fmt}")
+    return resp
+
+@app.route('/capabilities')
+def capabilities():
+    """Which optional features this server can run, and whether their backends are loaded yet"""
+    return jsonify({'status': 'ok', 'capabilities': {name: capability(name) for name in CAPABILITIES}})
+
+@app.route('/analysis')
+def analysis():
+    """Waveform peaks (at the zoom level nearest spp), loudness and optionally the F0 track for a file"""
+    path = request.args.get('path')
+    if not path or not os.path.exists(path):
+        return jsonify({'status': 'error', 'error': 'File not found'})
+    try:
+        data = analyze_file(path)
+    except Exception as e:
+        return jsonify({'status': 'error', 'error': str(e)})
+    spp = min(PEAK_LEVELS, key=lambda n: abs(n - request.args.get('spp', PEAK_LEVELS[1], type=int)))
+    sr, hop = int(data['sr']), int(data['hop'])
+    out = {
+        'status': 'ok',
+        'samplerate': sr,
+        'duration': int(data['frames']) / sr,
+        'lufs': None if np.isnan(data['lufs']) else round(float(data['lufs']), 2),
+        'rms_db': round(float(20 * np.log10(max(float(np.sqrt(np.mean(data['rms'] ** 2))), 1e-9))), 2),
+        'spp': spp,
+        # [[min, max], ...] per bucket, scaled to -127..127
+        'peaks': data[f'peaks_{spp}'].tolist(),
+    }
+    if request.args.get('f0'):
+        out.update(hop=hop, f0=[None if np.isnan(f) else round(float(f), 2) for f in data['f0']])
+    return jsonify(out)
+
+def live_config(msg):
+    """The settings object in a text frame; ValueError for anything else"""
+    if not isinstance(msg, str):
+        raise ValueError('Expected a JSON settings message')
+    try:
+        config = json.loads(msg)
+    except json.JSONDecodeError:
+        raise ValueError('Settings must be JSON')
+    if not isinstance(config, dict):
+        raise ValueError('Settings must be a JSON object')
+    return config
+
+def live(ws):
+    """WebSocket: a JSON {sr, mode, amount} message first (and again to change settings), then
+    binary mono float32 blocks; every block comes back processed, the same length"""
+    try:
+        config = live_config(ws.receive())
+        dsp = LivePitch(config.get('sr'), config.get('mode', 'shift'), config.get('amount', 0))
+    except ValueError as e:
+        ws.send(json.dumps({'type': 'error', 'error': str(e)}))
+        return
+    ws.send(json.dumps({'type': 'ready', 'latency_ms': round(dsp.latency * 1000, 1)}))
+    while True:
+        msg = ws.receive()
+        if isinstance(msg, str):
+            try:
+                config = live_config(msg)
+                dsp.configure(config.get('mode', dsp.mode), config.get('amount', dsp.amount))
+            except ValueError as e:
+                ws.send(json.dumps({'type': 'error', 'error': str(e)}))
+            continue
+        block = np.frombuffer(msg, dtype='<f4')
+        if len(block) > LIVE_MAX_BLOCK:
+            ws.send(json.dumps({'type': 'error', 'error': f'Blocks are limited to {LIVE_MAX_BLOCK} samples'}))
+            continue
+        ws.send(dsp.process(block).astype('<f4').tobytes())
+
+if sock:
+    sock.route('/live')(live)
 
 @app.route('/status')
 def status():
     return jsonify({
-        'processing': PROCESSING,
-        'tab': app.config.get('ACTIVE_TAB', 'rip'),
-        'should_reload': app.config.pop('SHOULD_RELOAD', False)
+        'processing': JOBS.active_count() > 0,
+        'tab': app.config.get('ACTIVE_TAB', 'rip')
     })
 
 # New route for saving recordings
 @app.route('/save', methods=['POST'])
 def save_recording():
+    # A take sent through /uploads is already stored; just hand back its path
+    if request.is_json:
+        filepath = uploaded_file(request.json.get('upload'))
+        if not filepath:
+            return jsonify({'status': 'error', 'error': 'Upload not found'})
+        return jsonify({'status': 'success', 'filename': os.path.basename(filepath), 'filepath': filepath})
+    
     if 'audio' not in request.files:
         return jsonify({'status': 'error', 'error': 'No audio file provided'})
     
     audio_file = request.files['audio']
     
-    # Create a temporary file
-    temp_dir = tempfile.mkdtemp()
-    webm_path = os.path.join(temp_dir, 'take.webm')
-    audio_file.save(webm_path)
-    
-    # Save the file for future download
-    DEST_DIR.mkdir(parents=True, exist_ok=True)
+    # Write the take once, straight to where it is kept for future download
     recordings_dir = DEST_DIR / "recordings"
-    recordings_dir.mkdir(exist_ok=True)
+    recordings_dir.mkdir(parents=True, exist_ok=True)
     
     timestamp = hashlib.md5(str(time.time()).encode()).hexdigest()[:8]
     save_path = recordings_dir / f"take_{timestamp}.webm"
-    shutil.copy(webm_path, save_path)
+    audio_file.save(save_path)
     
     return jsonify({'status': 'success', 'filename': save_path.name, 'filepath': str(save_path)})
 
@@ -476,7 +2733,7 @@ def play_audio():
     if not path or not os.path.exists(path):
         return jsonify({'status': 'error', 'error': 'File not found'})
     
-    return send_file(path)
+    return serve_audio(path)
 
 @app.route('/save-stem')
 def save_stem():
@@ -490,57 +2747,79 @@ def save_stem():
     
     return jsonify({'status': 'success', 'message': f'Saved to {dest}'})
 
-# Function to preview audio using sounddevice
-def preview_audio(audio_file, duration=5):
-    """Preview audio using sounddevice for direct playback"""
+# Local mode: play on the server's own sound card (only useful when it runs on your machine)
+def preview_audio(audio_file, duration=5, start=0):
+    """Start playing a window of audio_file through sounddevice; returns without waiting for it to finish"""
     try:
-        if 'sounddevice' not in sys.modules or 'soundfile' not in sys.modules:
+        if not capability('local-preview')['available']:
             return False, "Required modules (sounddevice, soundfile) not available"
-        
-        # Get audio info first to use sample rate
-        info = sf.info(audio_file)
-        sample_rate = info.samplerate
-        
-        # Load the audio file (just the first few seconds for preview)
-        data, sample_rate = sf.read(audio_file, frames=int(duration * sample_rate))
-        
-        # Play the audio using sounddevice
-        sd.play(data, sample_rate)
-        sd.wait()  # Wait until the audio is done playing
-        
+        require('local-preview')
+        window = read_window(audio_file, start, duration)
+        if window is None:
+            return False, f"Cannot read {os.path.basename(audio_file)}"
+        sd.play(*window)
         return True, None
     except Exception as e:
         return False, str(e)
 
+def preview_args(args):
+    """(start, duration) from request args, duration capped at PREVIEW_MAX_SECONDS"""
+    start = max(float(args.get('start', 0)), 0.0)
+    duration = min(max(float(args.get('duration', 5.0)), 0.0), PREVIEW_MAX_SECONDS)
+    return start, duration
+
+@app.route('/preview')
+def preview_stream():
+    """A window of a file, encoded for the browser (?path=&start=&duration=&format=opus|mp3|wav)"""
+    path = request.args.get('path')
+    kind = request.args.get('format', 'opus')
+    if not path or not os.path.exists(path):
+        return jsonify({'status': 'error', 'error': 'File not found'}), 404
+    if kind not in PREVIEW_PRESETS and kind != 'wav':
+        return jsonify({'status': 'error', 'error': f'Unknown preview format {kind}'}), 400
+    try:
+        # A wav window of a file soundfile can read needs no ffmpeg
+        require('preview' if kind in PREVIEW_PRESETS else 'wav-preview')
+        chunks, mimetype = preview_window(path, *preview_args(request.args), kind)
+    except Exception as e:
+        return jsonify({'status': 'error', 'error': str(e)}), 500
+    return Response(chunks, mimetype=mimetype, headers={'Cache-Control': 'no-store'})
+
 # New route for audio preview
 @app.route('/preview-audio', methods=['POST'])
 def preview_audio_endpoint():
+    """Stream mode (default) returns a /preview URL for the browser; mode 'local' plays on the server"""
     try:
         data = request.json
         audio_path = data.get('file')
-        duration = float(data.get('duration', 5.0))  # Default to 5 seconds
+        start, duration = preview_args(data)
         
         if not audio_path or not os.path.exists(audio_path):
             return jsonify({'status': 'error', 'error': 'File not found'})
         
-        success, error = preview_audio(audio_path, duration)
+        if data.get('mode', 'stream') != 'local':
+            return jsonify({
+                'status': 'success',
+                'url': url_for('preview_stream', path=audio_path, start=start, duration=duration,
+                               format=data.get('format', 'opus')),
+            })
+        
+        success, error = preview_audio(audio_path, duration, start)
         
         if not success:
             return jsonify({'status': 'error', 'error': error})
         
         return jsonify({
             'status': 'success',
-            'message': f'Played {duration} seconds of audio'
+            'message': f'Playing {duration} seconds of audio'
         })
     except Exception as e:
         return jsonify({'status': 'error', 'error': str(e)})
 
 if __name__ == '__main__':
-    import time  # Added for timestamp in recordings
-    
     # Initialize configuration
-    app.config['SHOULD_RELOAD'] = False
     app.config['ACTIVE_TAB'] = 'rip'
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     
     # Run the app on all network interfaces
     app.run(host='0.0.0.0', port=8080, debug=True) 
@@ -62,6 +62,7 @@ function buildGraph(stream) {
   nodes.eqLow.connect(nodes.eqHigh);
   nodes.eqHigh.connect(nodes.comp);
   nodes.comp.connect(dry).connect(audioCtx.destination);
+  nodes.dry = dry;
 
   // delay send
   nodes.comp.connect(nodes.delay);
@@ -105,6 +106,79 @@ function applyParam(id, val) {
   }
 }
 
+/* Live pitch: stream the mic to /live over a WebSocket and monitor what comes back */
+let live = null;
+const liveMode = document.getElementById("liveMode");
+const liveAmount = document.getElementById("liveAmount");
+
+function startLive() {
+  const ws = new WebSocket(`${location.protocol === "https:" ? "wss" : "ws"}://${location.host}/live`);
+  ws.binaryType = "arraybuffer";
+  const queue = [];
+  const proc = audioCtx.createScriptProcessor(1024, 1, 1);
+  proc.onaudioprocess = e => {
+    if (ws.readyState === WebSocket.OPEN) ws.send(new Float32Array(e.inputBuffer.getChannelData(0)));
+    const out = e.outputBuffer.getChannelData(0);
+    const next = queue.shift();
+    out.set(next && next.length === out.length ? next : new Float32Array(out.length));
+  };
+  ws.onopen = () => ws.send(JSON.stringify({
+    sr: audioCtx.sampleRate, mode: liveMode.value, amount: parseFloat(liveAmount.value)
+  }));
+  ws.onmessage = e => {
+    if (typeof e.data !== "string") {
+      queue.push(new Float32Array(e.data));
+      if (queue.length > 4) queue.shift();  // drop audio rather than let latency build up
+      return;
+    }
+    const msg = JSON.parse(e.data);
+    status.textContent = msg.type === "ready"
+      ? `Live ${liveMode.value} on (${msg.latency_ms} ms processing delay)`
+      : `Live pitch error: ${msg.error}`;
+  };
+  ws.onclose = () => stopLive();
+  nodes.comp.connect(proc);
+  proc.connect(audioCtx.destination);
+  nodes.dry.gain.value = 0;
+  live = { ws, proc };
+}
+
+function stopLive() {
+  if (!live) return;
+  const { ws, proc } = live;
+  live = null;
+  liveMode.value = "off";
+  ws.close();
+  proc.disconnect();
+  nodes.comp.disconnect(proc);
+  nodes.dry.gain.value = 1;
+}
+
+liveMode.addEventListener("change", () => {
+  if (liveMode.value === "autotune") {
+    liveAmount.min = 0; liveAmount.max = 10; liveAmount.value = 10;
+  } else {
+    liveAmount.min = -12; liveAmount.max = 12; liveAmount.value = 0;
+  }
+  if (!audioCtx) {
+    status.textContent = "Arm the mic first";
+    liveMode.value = "off";
+    return;
+  }
+  if (liveMode.value === "off") return stopLive();
+  if (live) {
+    live.ws.send(JSON.stringify({ mode: liveMode.value, amount: parseFloat(liveAmount.value) }));
+  } else {
+    startLive();
+  }
+});
+
+liveAmount.addEventListener("input", () => {
+  if (live && live.ws.readyState === WebSocket.OPEN) {
+    live.ws.send(JSON.stringify({ amount: parseFloat(liveAmount.value) }));
+  }
+});
+
 /* Record / Stop */
 recBtn.onclick = () => {
   chunks = [];